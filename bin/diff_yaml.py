@@ -19,10 +19,60 @@
 #
 from __future__ import print_function
 import argparse
+import concurrent.futures
+import copy
 import datadiff
+import glob
+import hashlib
+import io
+import json
+import mmap
+import os
+import re
+import struct
 import sys
+import tempfile
+import time
 import yaml  # pyyaml
 
+# use the libyaml bindings when pyyaml was built with them
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+    YAML_BACKEND = "libyaml"
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+    YAML_BACKEND = "python"
+
+# document markers of a multi document yaml stream
+DOC_START = re.compile(br'^---(\s|$)')
+DOC_END = re.compile(br'^\.\.\.(\s|$)')
+# lines that may come before the "---" of a document
+DOC_PROLOGUE = re.compile(br'^(%|\s*(#|$))')
+
+# on disk index cache: a header followed by fixed size records and the
+# utf-8 resource names they point into
+CACHE_MAGIC = b"DYIX"
+CACHE_VERSION = 3
+CACHE_HEADER = struct.Struct("<4sII")
+CACHE_RECORD = struct.Struct("<16sQQII")
+
+# parsed ConfigMap values by digest of their content, so identical values are
+# parsed once per process
+PARSED_VALUES = {}
+
+
+def load(stream):
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def load_all(stream):
+    return yaml.load_all(stream, Loader=SafeLoader)
+
+
+def dump(data, **kwargs):
+    return yaml.dump(data, Dumper=SafeDumper, **kwargs)
+
+
 # returns fully qualified resource name of the k8s resource
 
 
@@ -50,21 +100,41 @@ def drop_keys(res, k1, k2):
         del res[k1][k2]
 
 
-def normalize_configmap(res):
+def parse_value(value):
+    if not isinstance(value, str):
+        return value
+
+    key = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+    if key not in PARSED_VALUES:
+        try:
+            PARSED_VALUES[key] = list(load_all(value))
+        except yaml.YAMLError as ex:
+            print(ex, file=sys.stderr)
+            PARSED_VALUES[key] = value
+
+    # a copy, so the dumper does not emit aliases for values parsed once
+    return copy.deepcopy(PARSED_VALUES[key])
+
+
+# returns a ConfigMap with its values parsed, since some times they are
+# yamls. Values equal to the same key of other are left as is, they can not
+# differ once parsed either. Resources are normalized with the raw values,
+# so this only runs for ConfigMaps that changed.
+
+
+def normalize_configmap(res, other=None):
     try:
         if res['kind'] != "ConfigMap":
             return res
 
         data = res['data']
+        if not data:
+            return res
 
-        # some times keys are yamls...
-        # so parse them
-        for k in data:
-            try:
-                op = yaml.safe_load_all(data[k])
-                data[k] = list(op)
-            except yaml.YAMLError as ex:
-                print(ex)
+        other_data = (other or {}).get('data') or {}
+        res = dict(res)
+        res['data'] = {k: v if other_data.get(k) == v else parse_value(v)
+                       for k, v in data.items()}
 
         return res
     except KeyError as ke:
@@ -102,38 +172,511 @@ def normalize_res(res, args):
 
     res = normalize_ports(res)
 
-    res = normalize_configmap(res)
-
     return res
 
 
-def normalize(rl, args):
-    for i in range(len(rl)):
-        rl[i] = normalize_res(rl[i], args)
+# yields (offset, length) of every document in a multi document yaml file
+# without parsing it. Documents are split on "---" and "..." markers at the
+# start of a line, which is how rendered manifests are laid out. Directives
+# ("%YAML", "%TAG"), comments and blank lines before a "---" belong to the
+# document it starts. The splitter does not check that the stream is valid:
+# text that is not a document marker but starts with "---" or "..." in the
+# first column, e.g. in an unindented multi line scalar, still splits the
+# document, and a syntax error only fails the document it is in.
+
+
+def split_documents(path):
+    offset = 0
+    start = 0
+    # whether the lines since start hold more than directives and comments
+    content = False
+    with open(path, 'rb') as f:
+        for line in f:
+            if DOC_START.match(line) and content:
+                yield start, offset - start
+                start = offset
+
+            offset += len(line)
+
+            if DOC_END.match(line):
+                yield start, offset - start
+                start = offset
+                content = False
+            elif DOC_START.match(line) or not DOC_PROLOGUE.match(line):
+                content = True
+
+    if offset > start:
+        yield start, offset - start
+
+
+def load_document(f, offset, length):
+    f.seek(offset)
+    return load(f.read(length))
+
+
+# returns a json serializable form of a value that keeps the yaml types
+# apart. Keys are prefixed with their type, so 1 and "1" differ, and values
+# json does not have, e.g. dates, are tagged with theirs.
+
+
+def canonical(v):
+    if isinstance(v, dict):
+        return {"{}:{}".format(type(k).__name__, k): canonical(x)
+                for k, x in v.items()}
+
+    if isinstance(v, list):
+        return [canonical(x) for x in v]
+
+    if v is None or isinstance(v, (str, int, float)):
+        return v
+
+    if isinstance(v, (set, frozenset)):
+        return {"!set": sorted(json.dumps(canonical(x), sort_keys=True)
+                               for x in v)}
+
+    return {"!" + type(v).__name__: str(v)}
+
+
+# returns a compact digest of the canonical form of a normalized resource
+
+
+def fingerprint(res):
+    data = json.dumps(canonical(res), sort_keys=True, separators=(',', ':'))
+
+    return hashlib.blake2b(data.encode('utf-8'), digest_size=16).digest()
+
+
+# runs fn in the pool, or inline when there is no pool
+
+
+def submit(pool, fn, *args):
+    if pool is not None:
+        return pool.submit(fn, *args)
+
+    f = concurrent.futures.Future()
+    f.set_result(fn(*args))
+    return f
+
+
+# splits the documents of a file into one batch per pool task
+
+
+def batch_documents(path, args):
+    docs = list(split_documents(path))
+    size = max(1, len(docs) // (args.jobs * 4))
+
+    return [docs[i:i + size] for i in range(0, len(docs), size)]
+
+
+def load_documents(path, docs, args):
+    out = []
+    with open(path, 'rb') as f:
+        for offset, length in docs:
+            res = normalize_res(load_document(f, offset, length), args)
+            if res is not None:
+                out.append((by_resource_name(res), (fingerprint(res), res)))
+
+    return out
+
+
+def index_documents(path, docs, args):
+    out = []
+    with open(path, 'rb') as f:
+        for offset, length in docs:
+            res = normalize_res(load_document(f, offset, length), args)
+            if res is not None:
+                out.append((by_resource_name(res),
+                            (fingerprint(res), offset, length)))
+
+    return out
+
+
+# parses and normalizes orig and new concurrently, spreading the documents of
+# each file across the pool. Returns one {resource name: fn result} per file.
+
+
+def process_files(paths, args, pool, fn):
+    tasks = []
+    for path in paths:
+        tasks.append([submit(pool, fn, path, docs, args)
+                      for docs in batch_documents(path, args)])
+
+    return [dict(e for t in tl for e in t.result()) for tl in tasks]
+
+
+# returns {resource name: (fingerprint, resource)} for orig and new. The
+# documents are split the same way with and without a pool, so -j does not
+# change which inputs are accepted.
+
+
+def load_files(args, pool):
+    return process_files((args.orig, args.new), args, pool, load_documents)
+
+
+# the cache key covers the file content and the flags that change how
+# resources are normalized
+
+
+def cache_key(path, args):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+
+    h.update("{}:{}:{}".format(CACHE_VERSION, args.ignore_labels,
+                               args.ignore_namespace).encode('utf-8'))
+
+    return h.hexdigest()
+
+
+def read_index(cache_dir, key):
+    try:
+        f = open(os.path.join(cache_dir, key + ".idx"), 'rb')
+    except IOError:
+        return None
+
+    # a partially restored or truncated index counts as a miss and is rewritten
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size < CACHE_HEADER.size:
+            return None
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                magic, version, count = CACHE_HEADER.unpack_from(m, 0)
+                if magic != CACHE_MAGIC or version != CACHE_VERSION:
+                    return None
+
+                names = CACHE_HEADER.size + count * CACHE_RECORD.size
+                if size < names:
+                    return None
+                idx = {}
+                for i in range(count):
+                    pos = CACHE_HEADER.size + i * CACHE_RECORD.size
+                    digest, offset, length, name_offset, name_length = \
+                        CACHE_RECORD.unpack_from(m, pos)
+                    if names + name_offset + name_length > size:
+                        return None
+                    name = m[names + name_offset:names + name_offset + name_length]
+                    idx[name.decode('utf-8')] = (digest, offset, length)
+
+                return idx
+        except (ValueError, struct.error, UnicodeDecodeError):
+            return None
+
+
+def write_index(cache_dir, key, idx):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    records = []
+    names = []
+    name_offset = 0
+    for name, (digest, offset, length) in sorted(idx.items()):
+        name = name.encode('utf-8')
+        records.append(CACHE_RECORD.pack(digest, offset, length,
+                                         name_offset, len(name)))
+        names.append(name)
+        name_offset += len(name)
+
+    # write to a temporary file first so readers never see a partial index
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    with os.fdopen(fd, 'wb') as f:
+        f.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, len(records)))
+        f.write(b"".join(records))
+        f.write(b"".join(names))
+
+    os.replace(tmp, os.path.join(cache_dir, key + ".idx"))
+
+
+# returns {resource name: (fingerprint, offset, length)} for each input file.
+# Only one document per worker is held in memory at a time. With a cache
+# directory, files that were indexed before are not parsed again.
+
+
+def index_files(args, pool):
+    paths = (args.orig, args.new)
+    if not args.cache_dir:
+        return process_files(paths, args, pool, index_documents)
+
+    keys = [cache_key(path, args) for path in paths]
+    idx = [read_index(args.cache_dir, key) for key in keys]
+
+    missing = [i for i in range(len(paths)) if idx[i] is None]
+    indexed = process_files([paths[i] for i in missing], args, pool,
+                            index_documents)
+    for i, res in zip(missing, indexed):
+        write_index(args.cache_dir, keys[i], res)
+        idx[i] = res
+
+    return idx
+
+
+# returns the summary of a comparison, also used for the json report
+
+
+def summarize(args, added, removed, common, changed):
+    return {
+        "orig": args.orig,
+        "new": args.new,
+        "added": sorted(added),
+        "removed": sorted(removed),
+        "updated": changed,
+        "unchanged": len(common) - len(changed),
+    }
+
+
+def count_changes(result):
+    return len(result["added"]) + len(result["removed"]) + len(result["updated"])
+
+
+def print_summary(result, out=sys.stdout):
+    print("## +++ ", result["new"], file=out)
+    print("## --- ", result["orig"], file=out)
+    print("## Added:", len(result["added"]), file=out)
+    print("## Removed:", len(result["removed"]), file=out)
+    print("## Updated:", len(result["updated"]), file=out)
+    print("## Unchanged:", result["unchanged"], file=out)
+
+    for k in result["added"]:
+        print("+", k, file=out)
+
+    for k in result["removed"]:
+        print("-", k, file=out)
+
+    print("##", "*" * 25, file=out)
+
 
-    return rl
+def key_path(path, k):
+    if isinstance(k, int):
+        return "{}[{}]".format(path, k)
 
+    k = str(k)
+    if "." in k:
+        return "{}[{}]".format(path, json.dumps(k))
 
-def compare(args):
-    j0 = normalize(list(yaml.safe_load_all(open(args.orig))), args)
-    j1 = normalize(list(yaml.safe_load_all(open(args.new))), args)
+    return "{}.{}".format(path, k) if path else k
 
-    q0 = {by_resource_name(res): res for res in j0 if res is not None}
-    q1 = {by_resource_name(res): res for res in j1 if res is not None}
+
+# yields (op, key path, old, new) for every leaf that differs between a and b
+
+
+def structural_diff(a, b, path=""):
+    if isinstance(a, dict) and isinstance(b, dict):
+        for k in sorted(set(a) | set(b), key=str):
+            p = key_path(path, k)
+            if k not in b:
+                yield "-", p, a[k], None
+            elif k not in a:
+                yield "+", p, None, b[k]
+            else:
+                for d in structural_diff(a[k], b[k], p):
+                    yield d
+    elif isinstance(a, list) and isinstance(b, list):
+        for i in range(max(len(a), len(b))):
+            p = key_path(path, i)
+            if i >= len(b):
+                yield "-", p, a[i], None
+            elif i >= len(a):
+                yield "+", p, None, b[i]
+            else:
+                for d in structural_diff(a[i], b[i], p):
+                    yield d
+    elif a != b or type(a) is not type(b):
+        yield "~", path, a, b
+
+
+def format_value(v):
+    try:
+        return json.dumps(v, sort_keys=True)
+    except (TypeError, ValueError):
+        # values json does not have, e.g. dates, are printed in yaml flow
+        # style, so they are told apart from strings
+        s = dump(v, default_flow_style=True, width=1 << 30)
+        return s[:-len("...\n")].strip() if s.endswith("\n...\n") else s.strip()
+
+
+def format_diff(args, k, r0, r1):
+    if args.structural:
+        lines = ["##  {}".format(k)]
+        for op, p, v0, v1 in structural_diff(r0, r1):
+            if op == "+":
+                lines.append("+ {}: {}".format(p, format_value(v1)))
+            elif op == "-":
+                lines.append("- {}: {}".format(p, format_value(v0)))
+            else:
+                lines.append("~ {}: {} -> {}".format(
+                    p, format_value(v0), format_value(v1)))
+
+        return "\n".join(lines) + "\n"
+
+    s0 = dump(r0, default_flow_style=False, indent=2)
+    s1 = dump(r1, default_flow_style=False, indent=2)
+
+    return "##  {}\n{}".format(
+        k, datadiff.diff(s0, s1, fromfile=args.orig, tofile=args.new))
+
+
+# returns the diff of two resources with different fingerprints, or None when
+# they are ConfigMaps whose values only differ before parsing
+
+
+def diff_resources(args, k, r0, r1):
+    if r0.get('kind') == r1.get('kind') == "ConfigMap":
+        if fingerprint(normalize_configmap(r0, r1)) == \
+                fingerprint(normalize_configmap(r1, r0)):
+            return None
+
+        r0 = normalize_configmap(r0)
+        r1 = normalize_configmap(r1)
+
+    return format_diff(args, k, r0, r1)
+
+
+def format_document_diff(args, k, loc0, loc1):
+    with open(args.orig, 'rb') as f0, open(args.new, 'rb') as f1:
+        r0 = normalize_res(load_document(f0, *loc0), args)
+        r1 = normalize_res(load_document(f1, *loc1), args)
+
+    return diff_resources(args, k, r0, r1)
+
+
+# waits for the diff tasks of the resources with differing fingerprints, in
+# submission order so output stays sorted. Resources without a diff are
+# unchanged. Returns the summary and the diffs.
+
+
+def collect_diffs(args, added, removed, common, keys, tasks):
+    diffs = [(k, t.result()) for k, t in zip(keys, tasks)]
+    diffs = [(k, d) for k, d in diffs if d is not None]
+
+    result = summarize(args, added, removed, common, [k for k, _ in diffs])
+
+    return result, [d for _, d in diffs]
+
+
+def compare(args, pool=None, out=sys.stdout):
+    q0, q1 = load_files(args, pool)
 
     added, removed, common = keydiff(q0.keys(), q1.keys())
 
-    changed = 0
-    for k in sorted(common):
-        if q0[k] != q1[k]:
-            changed += 1
+    # resources with equal fingerprints are unchanged
+    keys = [k for k in sorted(common) if q0[k][0] != q1[k][0]]
+    tasks = [submit(pool, diff_resources, args, k, q0[k][1], q1[k][1])
+             for k in keys]
+
+    result, diffs = collect_diffs(args, added, removed, common, keys, tasks)
+    print_summary(result, out)
+
+    for d in diffs:
+        print(d, file=out)
+
+    return result
+
+
+# compares the files keeping only a fingerprint and the file offsets of each
+# resource in memory. Only resources with differing fingerprints are parsed
+# again to produce the diff.
+
+
+def compare_stream(args, pool=None, out=sys.stdout):
+    i0, i1 = index_files(args, pool)
+
+    added, removed, common = keydiff(i0.keys(), i1.keys())
+
+    keys = [k for k in sorted(common) if i0[k][0] != i1[k][0]]
+    tasks = [submit(pool, format_document_diff, args, k, i0[k][1:], i1[k][1:])
+             for k in keys]
+
+    result, diffs = collect_diffs(args, added, removed, common, keys, tasks)
+    print_summary(result, out)
+
+    for d in diffs:
+        print(d, file=out)
+
+    return result
+
+
+# returns {relative path: path} of the yaml files in a directory, or of the
+# files matching a glob relative to the glob's directory
+
+
+def match_files(spec):
+    if os.path.isdir(spec):
+        root = spec
+        paths = [os.path.join(d, f)
+                 for d, _, files in os.walk(spec) for f in files
+                 if f.endswith((".yaml", ".yml"))]
+    else:
+        root = os.path.dirname(re.split(r'[*?[]', spec, 1)[0])
+        paths = glob.glob(spec, recursive=True)
+
+    return {os.path.relpath(p, root): p for p in paths if os.path.isfile(p)}
+
+
+def is_batch(args):
+    if os.path.isdir(args.orig) and os.path.isdir(args.new):
+        return True
+
+    return any(c in p for p in (args.orig, args.new) for c in "*?[")
+
+
+# compares one pair of files and returns its summary and printed output
+
+
+def compare_pair(args, orig, new):
+    pargs = copy.copy(args)
+    pargs.orig = orig
+    pargs.new = new
+
+    out = io.StringIO()
+    cmp = compare_stream if args.stream else compare
+    return cmp(pargs, out=out), out.getvalue()
+
+
+# compares every pair of files matched by relative path, one pair per pool
+# task, then prints a combined summary
+
+
+def compare_batch(args, pool=None):
+    f0 = match_files(args.orig)
+    f1 = match_files(args.new)
+
+    # a mistyped glob or an empty directory must not pass as "no changes".
+    # Changes use the statuses from 1 up, so this is a usage error like
+    # argparse's
+    for spec, files in ((args.orig, f0), (args.new, f1)):
+        if not files:
+            print("{}: error: no yaml files match {}".format(
+                os.path.basename(sys.argv[0]), spec), file=sys.stderr)
+            sys.exit(2)
+
+    added, removed, common = keydiff(f0.keys(), f1.keys())
+
+    results = []
+    for t in [submit(pool, compare_pair, args, f0[k], f1[k])
+              for k in sorted(common)]:
+        result, text = t.result()
+        sys.stdout.write(text)
+        results.append(result)
+
+    total = {
+        "orig": args.orig,
+        "new": args.new,
+        "added_files": sorted(added),
+        "removed_files": sorted(removed),
+        "pairs": results,
+    }
 
     print("## +++ ", args.new)
     print("## --- ", args.orig)
-    print("## Added:", len(added))
-    print("## Removed:", len(removed))
-    print("## Updated:", changed)
-    print("## Unchanged:", len(common) - changed)
+    print("## Compared:", len(results))
+    print("## Added files:", len(added))
+    print("## Removed files:", len(removed))
+    print("## Changed files:", len([r for r in results if count_changes(r)]))
+    for name in ("added", "removed", "updated"):
+        print("## {}:".format(name.capitalize()),
+              sum(len(r[name]) for r in results))
+    print("## Unchanged:", sum(r["unchanged"] for r in results))
 
     for k in sorted(added):
         print("+", k)
@@ -141,26 +684,91 @@ def compare(args):
     for k in sorted(removed):
         print("-", k)
 
-    print("##", "*" * 25)
+    return total
+
+
+# times loading and dumping the inputs with every available yaml backend
+
 
-    for k in sorted(common):
-        if q0[k] != q1[k]:
-            print("## ", k)
-            s0 = yaml.safe_dump(q0[k], default_flow_style=False, indent=2)
-            s1 = yaml.safe_dump(q1[k], default_flow_style=False, indent=2)
+def benchmark(args):
+    backends = [("python", yaml.SafeLoader, yaml.SafeDumper)]
+    if getattr(yaml, "__with_libyaml__", False):
+        backends.append(("libyaml", yaml.CSafeLoader, yaml.CSafeDumper))
 
-            print(datadiff.diff(s0, s1, fromfile=args.orig, tofile=args.new))
+    for path in (args.orig, args.new):
+        with open(path, 'rb') as f:
+            data = f.read()
 
-    return changed + len(added) + len(removed)
+        print("## ", path, len(data), "bytes")
+        for name, loader, dumper in backends:
+            start = time.time()
+            for _ in range(args.benchmark):
+                docs = list(yaml.load_all(data, Loader=loader))
+            load_time = (time.time() - start) / args.benchmark
+
+            start = time.time()
+            for _ in range(args.benchmark):
+                yaml.dump_all(docs, Dumper=dumper, default_flow_style=False)
+            dump_time = (time.time() - start) / args.benchmark
+
+            print("{:<8} load: {:.3f}s dump: {:.3f}s".format(
+                name, load_time, dump_time))
+
+    return 0
 
 
 def main(args):
-    return compare(args)
+    print("## yaml backend:", YAML_BACKEND, file=sys.stderr)
+
+    if args.benchmark:
+        return benchmark(args)
+
+    # the cache holds fingerprints and offsets, which is what --stream uses
+    if args.cache_dir:
+        args.stream = True
+
+    if is_batch(args):
+        cmp = compare_batch
+    elif args.stream:
+        cmp = compare_stream
+    else:
+        cmp = compare
+
+    if args.jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+            result = cmp(args, pool)
+    else:
+        result = cmp(args)
+
+    if "pairs" not in result:
+        result = {"orig": args.orig, "new": args.new,
+                  "added_files": [], "removed_files": [], "pairs": [result]}
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+    changes = len(result["added_files"]) + len(result["removed_files"]) + \
+        sum(count_changes(r) for r in result["pairs"])
+
+    # exit statuses wrap at 256, which would turn 256 changes into success.
+    # The exact counts are in the report.
+    return min(changes, 255)
+
+
+def positive_int(value):
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got {}".format(value))
+
+    return n
 
 
 def get_parser():
     parser = argparse.ArgumentParser(
-        description="Compare kubernetes yaml files")
+        description="Compare kubernetes yaml files. orig and new may also "
+                    "be two directories or globs, in which case every pair "
+                    "of files with the same relative path is compared")
 
     parser.add_argument("orig")
     parser.add_argument("new")
@@ -170,6 +778,25 @@ def get_parser():
                         help="Ignore resource labels during comparison")
     parser.add_argument("--ignore-annotations", action="store_true", default=False,
                         help="Ignore annotations during comparison")
+    parser.add_argument("--stream", action="store_true", default=False,
+                        help="Parse one document at a time and keep only a "
+                             "fingerprint per resource in memory")
+    parser.add_argument("--structural", action="store_true", default=False,
+                        help="Report the changed key paths of updated "
+                             "resources instead of a text diff")
+    parser.add_argument("--jobs", "-j", type=positive_int, default=1, metavar="N",
+                        help="Parse, normalize and diff resources, or compare "
+                             "file pairs in batch mode, with N worker "
+                             "processes")
+    parser.add_argument("--cache-dir", metavar="DIR",
+                        help="Cache the per resource fingerprints of each "
+                             "input in DIR, so unchanged inputs are not "
+                             "parsed again. Implies --stream")
+    parser.add_argument("--report", metavar="FILE",
+                        help="Write a json report of the comparison to FILE")
+    parser.add_argument("--benchmark", type=int, default=0, metavar="N",
+                        help="Time N rounds of loading and dumping the inputs "
+                             "with every available yaml backend and exit")
 
     return parser
 
@@ -177,4 +804,6 @@ def get_parser():
 if __name__ == "__main__":
     parser = get_parser()
     args = parser.parse_args()
+    if not is_batch(args) and (os.path.isdir(args.orig) or os.path.isdir(args.new)):
+        parser.error("a directory can only be compared with a directory or a glob")
     sys.exit(main(args))
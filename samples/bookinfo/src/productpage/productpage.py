@@ -14,23 +14,33 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import time
-import asyncio
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import heapq
+import hmac
+import itertools
 import logging
 import os
+import queue
+import random
 import requests
 import simplejson as json
 import sys
+import threading
+import time
+import zlib
 
-from flask import Flask, request, session, render_template, redirect, g, url_for
-from json2html import json2html
-from opentelemetry import trace
+# Only modules needed to serve /health and the request path are imported here. authlib (/login), json2html (/),
+# asyncio (FLOOD_FACTOR) and the OpenTelemetry SDK are imported on first use or after startup.
+# Run `python -X importtime -c "import productpage"` for a per module import profile.
+from flask import Flask, request, session, render_template, redirect, g, url_for, abort, has_request_context
 from opentelemetry.propagate import set_global_textmap
 from opentelemetry.propagators.b3 import B3MultiFormat
-from opentelemetry.sdk.trace import TracerProvider
-from prometheus_client import Counter, generate_latest
-from authlib.integrations.flask_client import OAuth
+from prometheus_client import Counter, Gauge, generate_latest
 from loguru import logger
+from markupsafe import Markup
 
 # These two lines enable debugging at httplib level (requests->urllib3->http.client)
 # You will see the REQUEST, including HEADERS and DATA, and RESPONSE with HEADERS but without DATA.
@@ -38,18 +48,122 @@ from loguru import logger
 import http.client as http_client
 http_client.HTTPConnection.debuglevel = 0
 
+# Time in milliseconds spent in each startup phase, logged once the request path is warm. The imports phase is the
+# CPU time of the process so far, i.e. the interpreter start and the imports above.
+startup_profile = {"imports": round(time.process_time() * 1000, 1)}
+startup_last = time.perf_counter()
+
+
+def mark_startup(phase):
+    global startup_last
+    now = time.perf_counter()
+    startup_profile[phase] = round((now - startup_last) * 1000, 1)
+    startup_last = now
+
+
 app = Flask(__name__)
 
-oauth = OAuth(app)
-oauth.register(
-    name="keycloak",
-    client_id="productpage",
-    client_secret="ZQBzxI5CU36UiQmrWtDbJkY3VOX5LJRY",
-    client_kwargs={"scope": "openid profile email"},
-    authorize_url="http://localhost:8080/realms/bookinfo/protocol/openid-connect/auth",
-    access_token_url="http://keycloak-http.keycloak.svc.cluster.local:8080/realms/bookinfo/protocol/openid-connect/token",
-    jwks_uri="http://keycloak-http.keycloak.svc.cluster.local:8080/realms/bookinfo/protocol/openid-connect/certs"
-)
+# Keycloak as seen by the browser, and by productpage. Point these at a local stand-in Keycloak for tests.
+keycloakExternalUrl = "http://localhost:8080" if (os.environ.get("KEYCLOAK_EXTERNAL_URL") is None) else os.environ.get("KEYCLOAK_EXTERNAL_URL")
+keycloakUrl = "http://keycloak-http.keycloak.svc.cluster.local:8080" if (os.environ.get("KEYCLOAK_URL") is None) else os.environ.get("KEYCLOAK_URL")
+keycloakRealmPath = "/realms/bookinfo/protocol/openid-connect"
+# Timeout in seconds of the calls to Keycloak
+keycloakTimeout = 3.0 if (os.environ.get("KEYCLOAK_TIMEOUT") is None) else float(os.environ.get("KEYCLOAK_TIMEOUT"))
+jwksCacheTtl = 300 if (os.environ.get("JWKS_CACHE_TTL") is None) else int(os.environ.get("JWKS_CACHE_TTL"))
+jwksMinRefreshInterval = 10 if (os.environ.get("JWKS_MIN_REFRESH_INTERVAL") is None) else int(os.environ.get("JWKS_MIN_REFRESH_INTERVAL"))
+
+
+class JWKSCache(object):
+    """Caches the JSON Web Key Set used to verify ID tokens.
+
+    The key set is fetched in the background at startup and every ttl seconds, so ID tokens are verified locally
+    on the login path. Failed fetches, e.g. while Keycloak is still starting, are retried after retry_interval
+    seconds, doubling up to ttl. An unknown kid, e.g. after Keycloak rotated its keys, refreshes the key set at most
+    once every min_refresh_interval seconds.
+    """
+
+    def __init__(self, uri, ttl, min_refresh_interval, timeout, retry_interval=1.0):
+        self.uri = uri
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.jwks = None
+        self.fetched_at = 0
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        # Only one fetch at a time. Callers waiting on the lock reuse its result.
+        with self.lock:
+            if self.jwks is not None and time.time() - self.fetched_at < self.min_refresh_interval:
+                return self.jwks
+            try:
+                res = requests.get(self.uri, timeout=self.timeout)
+                res.raise_for_status()
+                self.jwks = res.json()
+                self.fetched_at = time.time()
+                self.failed = False
+            except (requests.RequestException, ValueError) as e:
+                logger.error(f"Failed to fetch JWKS: {repr(e)}")
+                self.failed = True
+            return self.jwks
+
+    def fetch_jwk_set(self, force=False):
+        """ Replaces authlib's fetch_jwk_set, which is called with force=True on a kid miss """
+        jwks = self.refresh() if force or self.jwks is None else self.jwks
+        if jwks is None:
+            raise RuntimeError("JWKS is unavailable")
+        return jwks
+
+    def run(self):
+        retry = self.retry_interval
+        while True:
+            # Anything refresh raises is retried, so the thread keeps the key set fresh for the life of the process
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Failed to refresh JWKS: {repr(e)}")
+                self.failed = True
+            if self.failed or self.jwks is None:
+                time.sleep(retry)
+                retry = min(retry * 2, self.ttl)
+            else:
+                retry = self.retry_interval
+                time.sleep(self.ttl)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='jwks-refresh', daemon=True)
+        thread.start()
+        return thread
+
+
+oauth = None
+oauth_lock = threading.Lock()
+
+
+def get_oauth():
+    """ Registers the Keycloak client on first use, so authlib is not loaded before the first login """
+    global oauth
+    with oauth_lock:
+        if oauth is None:
+            from authlib.integrations.flask_client import OAuth
+
+            client = OAuth(app)
+            client.register(
+                name="keycloak",
+                client_id="productpage",
+                client_secret="ZQBzxI5CU36UiQmrWtDbJkY3VOX5LJRY",
+                client_kwargs={"scope": "openid profile email", "default_timeout": keycloakTimeout},
+                authorize_url=keycloakExternalUrl + keycloakRealmPath + "/auth",
+                access_token_url=keycloakUrl + keycloakRealmPath + "/token",
+                jwks_uri=keycloakUrl + keycloakRealmPath + "/certs"
+            )
+            # Verify ID tokens against the JWKS fetched in the background rather than on the login path
+            client.keycloak.fetch_jwk_set = jwks_cache.fetch_jwk_set
+            oauth = client
+    return oauth
+
 
 # loguruの設定
 logger.remove()
@@ -68,6 +182,9 @@ logger.add(
     )
 )
 
+# Prefetched in the background once the app is up, see warmup
+jwks_cache = JWKSCache(keycloakUrl + keycloakRealmPath + "/certs", jwksCacheTtl, jwksMinRefreshInterval, keycloakTimeout)
+
 # Set the secret key to some random bytes. Keep this really secret!
 app.secret_key = b'_5#y2L"F4Q8z\n\xec]/'
 
@@ -81,6 +198,45 @@ reviewsPort = "9080" if (os.environ.get("REVIEWS_SERVICE_PORT") is None) else os
 
 flood_factor = 0 if (os.environ.get("FLOOD_FACTOR") is None) else int(os.environ.get("FLOOD_FACTOR"))
 
+# Response compression. Brotli is used when the brotli package is installed and the client accepts it.
+compression = os.environ.get("COMPRESSION", "False") == "True"
+compressionMinSize = 1024 if (os.environ.get("COMPRESSION_MIN_SIZE") is None) else int(os.environ.get("COMPRESSION_MIN_SIZE"))
+compressionLevel = 6 if (os.environ.get("COMPRESSION_LEVEL") is None) else int(os.environ.get("COMPRESSION_LEVEL"))
+
+# Admission control. 0 disables it. The limit adapts between 1 and ADMISSION_MAX_IN_FLIGHT when a target latency in
+# seconds is set.
+admissionMaxInFlight = 0 if (os.environ.get("ADMISSION_MAX_IN_FLIGHT") is None) else int(os.environ.get("ADMISSION_MAX_IN_FLIGHT"))
+admissionQueueDepth = admissionMaxInFlight if (os.environ.get("ADMISSION_QUEUE_DEPTH") is None) else int(os.environ.get("ADMISSION_QUEUE_DEPTH"))
+admissionQueueTimeout = 1.0 if (os.environ.get("ADMISSION_QUEUE_TIMEOUT") is None) else float(os.environ.get("ADMISSION_QUEUE_TIMEOUT"))
+admissionTargetLatency = 0 if (os.environ.get("ADMISSION_TARGET_LATENCY") is None) else float(os.environ.get("ADMISSION_TARGET_LATENCY"))
+
+# Request hedging, for the comma separated backends in HEDGE_BACKENDS, e.g. "reviews". A second request is sent when
+# the first has not returned within the HEDGE_PERCENTILE latency of the backend, and at most HEDGE_BUDGET hedges are
+# sent per request on average. The first successful response is used, and the caller waits at most HEDGE_TIMEOUT
+# seconds.
+hedgeBackends = [] if (os.environ.get("HEDGE_BACKENDS") is None) else os.environ.get("HEDGE_BACKENDS").split(",")
+hedgePercentile = 95 if (os.environ.get("HEDGE_PERCENTILE") is None) else float(os.environ.get("HEDGE_PERCENTILE"))
+hedgeMinDelay = 0.05 if (os.environ.get("HEDGE_MIN_DELAY") is None) else float(os.environ.get("HEDGE_MIN_DELAY"))
+hedgeBudget = 0.1 if (os.environ.get("HEDGE_BUDGET") is None) else float(os.environ.get("HEDGE_BUDGET"))
+hedgeTimeout = 3.0 if (os.environ.get("HEDGE_TIMEOUT") is None) else float(os.environ.get("HEDGE_TIMEOUT"))
+
+# Client side load balancing, for deployments without a sidecar. DETAILS_ENDPOINTS, REVIEWS_ENDPOINTS and
+# RATINGS_ENDPOINTS are comma separated base URLs, e.g. "http://10.0.0.1:9080,http://10.0.0.2:9080". BACKEND_ENDPOINTS_FILE
+# is a JSON object of the same lists by backend name, re-read every BACKEND_ENDPOINTS_REFRESH seconds, and takes
+# precedence. LB_POLICY is "least_request" or "p2c" (power of two choices). An endpoint is ejected for
+# OUTLIER_EJECTION_TIME seconds after OUTLIER_CONSECUTIVE_ERRORS consecutive 5xx responses or connection errors.
+backendEndpointsFile = os.environ.get("BACKEND_ENDPOINTS_FILE")
+backendEndpointsRefresh = 10.0 if (os.environ.get("BACKEND_ENDPOINTS_REFRESH") is None) else float(os.environ.get("BACKEND_ENDPOINTS_REFRESH"))
+lbPolicy = "least_request" if (os.environ.get("LB_POLICY") is None) else os.environ.get("LB_POLICY")
+outlierConsecutiveErrors = 5 if (os.environ.get("OUTLIER_CONSECUTIVE_ERRORS") is None) else int(os.environ.get("OUTLIER_CONSECUTIVE_ERRORS"))
+outlierEjectionTime = 30.0 if (os.environ.get("OUTLIER_EJECTION_TIME") is None) else float(os.environ.get("OUTLIER_EJECTION_TIME"))
+
+# Number of rendered product and details fragments of /productpage kept in memory. 0 disables the cache.
+fragmentCacheSize = 128 if (os.environ.get("FRAGMENT_CACHE_SIZE") is None) else int(os.environ.get("FRAGMENT_CACHE_SIZE"))
+
+# Token required in the x-profiler-token header by /admin/profile. The endpoint does not exist unless it is set.
+profilerToken = os.environ.get("PROFILER_TOKEN")
+
 details = {
     "name": "http://{0}{1}:{2}".format(detailsHostname, servicesDomain, detailsPort),
     "endpoint": "details",
@@ -112,6 +268,342 @@ service_dict = {
 }
 
 request_result_counter = Counter('request_result', 'Results of requests', ['destination_app', 'response_code'])
+hedges_sent_counter = Counter('hedged_requests_sent', 'Hedged requests sent to backends', ['destination_app'])
+hedges_won_counter = Counter('hedged_requests_won', 'Hedged requests whose response was used instead of the original request', ['destination_app'])
+fragment_cache_counter = Counter('fragment_cache_requests', 'Lookups of rendered page fragments', ['result'])
+endpoints_ejected_counter = Counter('endpoints_ejected', 'Backend endpoints ejected as outliers', ['destination_app'])
+
+
+class FragmentCache(object):
+    """ LRU cache of rendered template fragments.
+
+    Keys must cover everything the fragment is rendered from, so entries never need to be invalidated.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.fragments = collections.OrderedDict()
+
+    def get(self, key, render):
+        """ Returns the fragment of key, rendering and caching it with render() on a miss """
+        if self.size <= 0:
+            return render()
+        with self.lock:
+            fragment = self.fragments.get(key)
+            if fragment is not None:
+                self.fragments.move_to_end(key)
+        if fragment is not None:
+            fragment_cache_counter.labels(result='hit').inc()
+            return fragment
+
+        fragment_cache_counter.labels(result='miss').inc()
+        fragment = render()
+        with self.lock:
+            self.fragments[key] = fragment
+            while len(self.fragments) > self.size:
+                self.fragments.popitem(last=False)
+        return fragment
+
+
+fragment_cache = FragmentCache(fragmentCacheSize)
+
+
+class Compressor(object):
+    """ Compresses response bodies with brotli or gzip, depending on the Accept-Encoding of the request """
+
+    compressible_types = ('text/', 'application/json', 'application/javascript')
+
+    def __init__(self, min_size, level):
+        self.min_size = min_size
+        self.level = level
+        # The gzip compressor is set up once and copied for each response
+        self.gzip = zlib.compressobj(level, zlib.DEFLATED, 31)
+        try:
+            import brotli
+            self.brotli = brotli
+        except ImportError:
+            self.brotli = None
+
+    def compressible(self, response):
+        return response.status_code == 200 and not response.direct_passthrough \
+            and 'Content-Encoding' not in response.headers \
+            and (response.mimetype or '').startswith(self.compressible_types)
+
+    def encoding(self, request, response):
+        """ Returns the encoding to compress the response with, or None """
+        if response.content_length is not None and response.content_length < self.min_size:
+            return None
+        if self.brotli is not None and request.accept_encodings['br']:
+            return 'br'
+        if request.accept_encodings['gzip']:
+            return 'gzip'
+        return None
+
+    def compress(self, data, encoding):
+        if encoding == 'br':
+            return self.brotli.compress(data, quality=self.level)
+        gzip = self.gzip.copy()
+        return gzip.compress(data) + gzip.flush()
+
+
+compressor = Compressor(compressionMinSize, compressionLevel) if compression else None
+
+requests_shed_counter = Counter('requests_shed', 'Requests rejected by admission control', ['priority'])
+admission_limit_gauge = Gauge('admission_limit', 'Current concurrency limit of admission control')
+
+# Priorities of admission control, lower is served first
+PRIORITY_PAGE = 0
+PRIORITY_API = 1
+
+
+class AdmissionController(object):
+    """ Limits the requests in flight and queues a bounded number of requests for a free slot.
+
+    Requests that find the queue full, or wait longer than queue_timeout seconds, are shed. Page requests are
+    admitted before queued API requests. With a target_latency, the limit decreases multiplicatively when requests
+    are slower than the target and increases additively, up to max_in_flight, when they are not.
+    """
+
+    def __init__(self, max_in_flight, queue_depth, queue_timeout, target_latency=0):
+        self.max_in_flight = max_in_flight
+        self.limit = float(max_in_flight)
+        self.queue_depth = queue_depth
+        self.queue_timeout = queue_timeout
+        self.target_latency = target_latency
+        self.in_flight = 0
+        # number of queued requests per priority
+        self.waiting = [0, 0]
+        self.cond = threading.Condition()
+        admission_limit_gauge.set(max_in_flight)
+
+    def can_admit(self, priority):
+        return self.in_flight < int(self.limit) and not any(self.waiting[:priority])
+
+    def acquire(self, priority):
+        """ Returns whether the request was admitted """
+        with self.cond:
+            if self.can_admit(priority):
+                self.in_flight += 1
+                return True
+            if sum(self.waiting) >= self.queue_depth:
+                return False
+
+            self.waiting[priority] += 1
+            try:
+                deadline = time.monotonic() + self.queue_timeout
+                while not self.can_admit(priority):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+                self.in_flight += 1
+                return True
+            finally:
+                self.waiting[priority] -= 1
+
+    def release(self, latency):
+        with self.cond:
+            self.in_flight -= 1
+            if self.target_latency:
+                if latency > self.target_latency:
+                    self.limit = max(1.0, self.limit * 0.9)
+                else:
+                    self.limit = min(float(self.max_in_flight), self.limit + 1.0 / self.limit)
+                admission_limit_gauge.set(int(self.limit))
+            self.cond.notify_all()
+
+
+admission = AdmissionController(admissionMaxInFlight, admissionQueueDepth, admissionQueueTimeout,
+                                admissionTargetLatency) if admissionMaxInFlight > 0 else None
+
+# Endpoints never shed by admission control
+admission_exempt = {'health', 'readiness', 'metrics', 'static', 'profile'}
+
+
+@app.before_request
+def admit_request():
+    if admission is None or request.endpoint in admission_exempt:
+        return None
+
+    priority = PRIORITY_API if request.path.startswith('/api/') else PRIORITY_PAGE
+    if not admission.acquire(priority):
+        requests_shed_counter.labels(priority=priority).inc()
+        return 'Product page is overloaded', 503, {'Retry-After': '1'}
+
+    g.admitted_at = time.monotonic()
+    return None
+
+
+@app.teardown_request
+def release_request(exc):
+    if 'admitted_at' in g:
+        admission.release(time.monotonic() - g.pop('admitted_at'))
+
+
+def gevent_patched():
+    """ True when gevent monkey patched threading, as in the gunicorn gevent workers of the Dockerfile """
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+class PhaseStats(object):
+    """ Wall and CPU time per route and phase. Only collected while /admin/profile runs.
+
+    CPU time is per OS thread, so it is not collected when greenlets share the threads.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.cpu = True
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.cpu = not gevent_patched()
+
+    def add(self, route, name, wall, cpu):
+        with self.lock:
+            stat = self.stats.setdefault(route, {}).setdefault(name, {'count': 0, 'wall_ms': 0.0})
+            stat['count'] += 1
+            stat['wall_ms'] += wall * 1000
+            if cpu is not None:
+                stat['cpu_ms'] = stat.get('cpu_ms', 0.0) + cpu * 1000
+
+    def snapshot(self):
+        with self.lock:
+            return {route: {name: dict(stat) for name, stat in phases.items()} for route, phases in self.stats.items()}
+
+
+phase_stats = PhaseStats()
+
+
+class Phase(object):
+    __slots__ = ('name', 'wall', 'cpu')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time() if phase_stats.cpu else None
+        return self
+
+    def __exit__(self, *exc):
+        route = request.endpoint if has_request_context() else None
+        cpu = time.thread_time() - self.cpu if self.cpu is not None else None
+        phase_stats.add(route, self.name, time.perf_counter() - self.wall, cpu)
+        return False
+
+
+class NoPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_PHASE = NoPhase()
+
+
+def phase(name):
+    """ Times a block as a phase of the current route while profiling, and does nothing otherwise """
+    return Phase(name) if phase_stats.active else NO_PHASE
+
+
+def timed_phase(name):
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@app.before_request
+def start_request_phase():
+    if phase_stats.active:
+        g.request_phase = Phase('total').__enter__()
+
+
+@app.teardown_request
+def end_request_phase(exc):
+    if 'request_phase' in g:
+        g.pop('request_phase').__exit__()
+
+
+def sample_stacks(seconds, interval, get_ident=threading.get_ident, sleep=time.sleep):
+    """ Samples the stacks of all other threads every interval seconds and counts them in collapsed format, root
+    first and separated by ';'. With gevent workers this runs in a native thread, see profile, so the sampled frames
+    are those of the greenlet running on each thread. Greenlets waiting for I/O are not visible """
+    counts = collections.Counter()
+    me = get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            counts[';'.join(reversed(stack))] += 1
+        sleep(interval)
+    return counts
+
+
+def sample_all_stacks(seconds, interval):
+    if not gevent_patched():
+        return sample_stacks(seconds, interval)
+
+    # A greenlet sampler would only ever see itself, since the greenlet it wants to sample is not running. A thread
+    # of the hub's pool, with the unpatched sleep and thread ids, samples whichever greenlet holds the worker thread.
+    import gevent
+    from gevent import monkey
+    return gevent.get_hub().threadpool.apply(sample_stacks, (
+        seconds, interval, monkey.get_original('threading', 'get_ident'), monkey.get_original('time', 'sleep')))
+
+
+profile_lock = threading.Lock()
+
+
+def cacheable(f):
+    """ Marks a route whose response only depends on the URL, so it gets a strong ETag and answers 304 """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        g.cacheable = True
+        return f(*args, **kwargs)
+    return wrapper
+
+
+@app.after_request
+def finalize_response(response):
+    encoding = None
+    if compressor is not None and compressor.compressible(response):
+        response.vary.add('Accept-Encoding')
+        encoding = compressor.encoding(request, response)
+
+    # The ETag is computed on the uncompressed body and tagged with the encoding, so each representation has its
+    # own strong ETag and a 304 is answered without compressing anything
+    if g.get('cacheable') and response.status_code == 200 and not response.direct_passthrough:
+        etag = hashlib.sha1(response.get_data()).hexdigest()
+        response.set_etag(etag + '-' + encoding if encoding else etag)
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+
+    if encoding is not None:
+        response.set_data(compressor.compress(response.get_data(), encoding))
+        response.headers['Content-Encoding'] = encoding
+
+    return response
 
 # A note on distributed tracing:
 #
@@ -137,13 +629,24 @@ request_result_counter = Counter('request_result', 'Results of requests', ['dest
 
 propagator = B3MultiFormat()
 set_global_textmap(B3MultiFormat())
-provider = TracerProvider()
-# Sets the global default tracer provider
-trace.set_tracer_provider(provider)
 
-tracer = trace.get_tracer(__name__)
+tracer = None
+
+
+def init_tracing():
+    """ Sets up the tracer provider. Forwarding headers does not need it, so it is done after startup """
+    global tracer
+    from opentelemetry import trace
+    from opentelemetry.sdk.trace import TracerProvider
 
+    provider = TracerProvider()
+    # Sets the global default tracer provider
+    trace.set_tracer_provider(provider)
 
+    tracer = trace.get_tracer(__name__)
+
+
+@timed_phase('header_propagation')
 def getForwardHeaders(request):
     headers = {}
 
@@ -229,20 +732,30 @@ def getForwardHeaders(request):
 # The UI:
 @app.route('/')
 @app.route('/index.html')
+@cacheable
 def index():
     """ Display productpage with normal user and test user buttons"""
     global productpage
+    from json2html import json2html
 
     table = json2html.convert(json=json.dumps(productpage),
                               table_attributes="class=\"table table-condensed table-bordered table-hover\"")
 
-    return render_template('index.html', serviceTable=table)
+    with phase('template_render'):
+        return render_template('index.html', serviceTable=table)
 
 
 @app.route('/health')
 def health():
     return 'Product page is healthy'
 
+
+@app.route('/ready')
+def readiness():
+    if not ready.is_set():
+        return 'Product page is starting', 503
+    return 'Product page is ready'
+
 @app.route('/login')
 def login():
     trace_id=get_trace_id()
@@ -251,7 +764,7 @@ def login():
     redirect_uri = url_for("callback", _external=True)
 
     try:
-        redirect_response = oauth.keycloak.authorize_redirect(redirect_uri)
+        redirect_response = get_oauth().keycloak.authorize_redirect(redirect_uri)
         if redirect_response and not (300 <= redirect_response.status_code < 400):
             logger.bind(trace_id=trace_id).error("Failed to authorize redirect")
             return redirect_response
@@ -269,11 +782,12 @@ def callback():
 
     try:
       # 各種トークンを取得する
-      token = oauth.keycloak.authorize_access_token()
+      token = get_oauth().keycloak.authorize_access_token()
       logger.bind(trace_id=trace_id).info("Authorize access token successfully")
       session['id_token'] = token['id_token']
       # デコードしたIDトークンを取得する
-      id_token = oauth.keycloak.parse_id_token(token, None)
+      # authorize_access_token already verified the ID token against the cached JWKS when the nonce is known
+      id_token = token.get('userinfo') or get_oauth().keycloak.parse_id_token(token, None)
       session['user'] = id_token['given_name']
       # Cookieヘッダーにアクセストークンを設定する
       response.set_cookie('access_token', token['access_token'])
@@ -294,7 +808,7 @@ def logout():
     try:
       # Keycloakからログアウトし、productpageにリダイレクトする
       redirect_uri = (
-          "http://localhost:8080/realms/bookinfo/protocol/openid-connect/logout?id_token_hint=%s&post_logout_redirect_uri=%s" %
+          keycloakExternalUrl + keycloakRealmPath + "/logout?id_token_hint=%s&post_logout_redirect_uri=%s" %
           (session.get('id_token', ''),
            url_for("front", _external=True))
            )
@@ -323,6 +837,7 @@ async def getProductReviewsIgnoreResponse(product_id, headers):
 
 
 async def floodReviewsAsynchronously(product_id, headers):
+    import asyncio
     # the response is disregarded
     await asyncio.gather(*(getProductReviewsIgnoreResponse(product_id, headers) for _ in range(flood_factor)))
 
@@ -330,6 +845,7 @@ async def floodReviewsAsynchronously(product_id, headers):
 
 
 def floodReviews(product_id, headers):
+    import asyncio
     loop = asyncio.new_event_loop()
     loop.run_until_complete(floodReviewsAsynchronously(product_id, headers))
     loop.close()
@@ -361,19 +877,29 @@ def front():
         redirect_uri = url_for('logout', _external=True)
         return redirect(redirect_uri)
 
-    response = app.make_response(render_template(
-        'productpage.html',
-        detailsStatus=detailsStatus,
-        reviewsStatus=reviewsStatus,
-        product=product,
-        details=details,
-        reviews=reviews,
-        user=user))
+    with phase('template_render'):
+        response = app.make_response(render_template(
+            'productpage.html',
+            product_details=renderProductDetails(product_id, product, detailsStatus, details),
+            reviewsStatus=reviewsStatus,
+            reviews=reviews,
+            user=user))
 
     return response
 
+
+def renderProductDetails(product_id, product, detailsStatus, details):
+    """ Renders the description and details sections, which are the same for every user given the details response """
+    version = hashlib.blake2b(json.dumps(details, sort_keys=True).encode('utf-8'), digest_size=16).digest()
+    return fragment_cache.get((product_id, detailsStatus, version), lambda: Markup(render_template(
+        'product_details.html',
+        detailsStatus=detailsStatus,
+        product=product,
+        details=details)))
+
 # API Gatewayとして
 @app.route('/api/v1/products')
+@cacheable
 def productsRoute():
     return json.dumps(getProducts()), 200, {'Content-Type': 'application/json'}
 
@@ -404,6 +930,36 @@ def metrics():
     return generate_latest()
 
 
+@app.route('/admin/profile')
+def profile():
+    """ Profiles all request threads for `seconds` (default 10, at most 60). Returns the sampled stacks in collapsed
+    format for flamegraph.pl, or with format=phases the wall and CPU time per route and phase of the requests
+    served meanwhile. CPU time is left out with gevent workers """
+    if profilerToken is None or not hmac.compare_digest(request.headers.get('x-profiler-token', ''), profilerToken):
+        abort(404)
+
+    try:
+        seconds = min(max(float(request.args.get('seconds', 10)), 0), 60)
+        # Shorter intervals would keep the GIL from the requests being profiled
+        interval = min(max(float(request.args.get('interval', 0.01)), 0.001), 1)
+    except ValueError:
+        return 'seconds and interval must be numbers', 400
+    if not profile_lock.acquire(blocking=False):
+        return 'A profile is already running', 409
+    try:
+        phase_stats.reset()
+        phase_stats.active = True
+        stacks = sample_all_stacks(seconds, interval)
+    finally:
+        phase_stats.active = False
+        profile_lock.release()
+
+    if request.args.get('format') == 'phases':
+        return json.dumps(phase_stats.snapshot()), 200, {'Content-Type': 'application/json'}
+    return ''.join('%s %d\n' % (stack, count) for stack, count in sorted(stacks.items())), 200, \
+        {'Content-Type': 'text/plain'}
+
+
 # Data providers:
 def getProducts():
     return [
@@ -428,14 +984,14 @@ def getProductDetails(product_id, headers):
     path = "/" + details['endpoint'] + "/" + str(product_id)
     url = details['name'] + path
     try:
-        res = send_request(url, headers=headers)
+        res = send_request(url, destination_app='details', headers=headers)
     except BaseException as e:
         logger.bind(trace_id=trace_id).error(f"Failed to fetch details: {repr(e)}")
         res = None
     if res and res.status_code == 200:
         request_result_counter.labels(destination_app='details', response_code=res.status_code).inc()
         logger.bind(trace_id=trace_id).info("Fetched details successfully")
-        return res.status_code, res.json()
+        return res.status_code, decode_json(res)
     elif res is not None and res.status_code == 401:
         request_result_counter.labels(destination_app='details', response_code=res.status_code).inc()
         logger.bind(trace_id=trace_id).info("Access token is invalid")
@@ -448,7 +1004,7 @@ def getProductDetails(product_id, headers):
         try:
           request_result_counter.labels(destination_app='details', response_code=res.status_code).inc()
           logger.bind(trace_id=trace_id).info("Failed to fetch details")
-          return res.status_code, res.json()
+          return res.status_code, decode_json(res)
         except BaseException as e:
           logger.bind(trace_id=trace_id).error(f"Failed to fetch details: {repr(e)}")
           # detailsサービスが503または504ステータスでJSONデータがない場合
@@ -466,14 +1022,14 @@ def getProductReviews(product_id, headers):
     url = reviews['name'] + path
 
     try:
-        res = send_request(url, headers=headers)
+        res = send_request(url, destination_app='reviews', headers=headers)
     except BaseException as e:
         logger.bind(trace_id=trace_id).error(f"Failed to fetch reviews: {repr(e)}")
         res = None
     if res and res.status_code == 200:
         request_result_counter.labels(destination_app='reviews', response_code=res.status_code).inc()
         logger.bind(trace_id=trace_id).info("Fetched reviews successfully")
-        return res.status_code, res.json()
+        return res.status_code, decode_json(res)
     elif res is not None and res.status_code == 401:
         request_result_counter.labels(destination_app='reviews', response_code=res.status_code).inc()
         logger.bind(trace_id=trace_id).info("Access token is invalid")
@@ -486,7 +1042,7 @@ def getProductReviews(product_id, headers):
         try:
           request_result_counter.labels(destination_app='reviews', response_code=res.status_code).inc()
           logger.bind(trace_id=trace_id).info("Failed to fetch reviews")
-          return res.status_code, res.json()
+          return res.status_code, decode_json(res)
         except BaseException as e:
           logger.bind(trace_id=trace_id).error(f"Failed to fetch reviews: {repr(e)}")
           # reviewsサービスが503または504ステータスでJSONデータがない場合
@@ -504,14 +1060,14 @@ def getProductRatings(product_id, headers):
     url = ratings['name'] + path
 
     try:
-        res = send_request(url, headers=headers)
+        res = send_request(url, destination_app='ratings', headers=headers)
     except BaseException as e:
         logger.bind(trace_id=trace_id).error(f"Failed to fetch ratings: {repr(e)}")
         res = None
     if res and res.status_code == 200:
         request_result_counter.labels(destination_app='ratings', response_code=res.status_code).inc()
         logger.bind(trace_id=trace_id).info("Fetched ratings successfully")
-        return res.status_code, res.json()
+        return res.status_code, decode_json(res)
     elif res is not None and res.status_code == 401:
         request_result_counter.labels(destination_app='ratings', response_code=res.status_code).inc()
         logger.bind(trace_id=trace_id).info("Access token is invalid")
@@ -524,7 +1080,7 @@ def getProductRatings(product_id, headers):
         try:
           request_result_counter.labels(destination_app='ratings', response_code=res.status_code).inc()
           logger.bind(trace_id=trace_id).info("Failed to fetch ratings")
-          return res.status_code, res.json()
+          return res.status_code, decode_json(res)
         except BaseException as e:
           logger.bind(trace_id=trace_id).error(f"Failed to fetch ratings: {repr(e)}")
           # ratingsサービスが503または504ステータスでJSONデータがない場合
@@ -536,11 +1092,265 @@ def getProductRatings(product_id, headers):
         return status, {'error': 'Sorry, product ratings are currently unavailable.'}
 
 
-def send_request(url, **kwargs):
-    # We intentionally do not pool so that we can easily test load distribution across many versions of our backends
+class Balancer(object):
+    """ Spreads the GET requests to one backend over a list of endpoints.
+
+    The endpoint with the fewest outstanding requests is picked, among all endpoints or, with the p2c policy, among two
+    picked at random. consecutive_errors 5xx responses or connection errors in a row eject an endpoint for
+    ejection_time seconds, unless every endpoint is ejected. Without endpoints, requests go to the base URL.
+    """
+
+    def __init__(self, destination_app, base, policy, consecutive_errors, ejection_time):
+        self.destination_app = destination_app
+        self.base = base
+        self.policy = policy
+        self.consecutive_errors = consecutive_errors
+        self.ejection_time = ejection_time
+        self.lock = threading.Lock()
+        self.endpoints = []
+        # [outstanding requests, consecutive errors, ejected until] per endpoint
+        self.state = {}
+
+    def update(self, endpoints):
+        endpoints = [e.rstrip('/') for e in endpoints if e]
+        with self.lock:
+            if endpoints == self.endpoints:
+                return
+            self.endpoints = endpoints
+            self.state = {e: self.state.get(e) or [0, 0, 0.0] for e in endpoints}
+        logger.info(f"Endpoints of {self.destination_app}: {endpoints}")
+
+    def pick(self):
+        with self.lock:
+            if not self.endpoints:
+                return None
+            now = time.monotonic()
+            candidates = [e for e in self.endpoints if self.state[e][2] <= now] or self.endpoints
+            if self.policy == 'p2c' and len(candidates) > 2:
+                candidates = random.sample(candidates, 2)
+            # Ties are broken at random so that idle endpoints share the load
+            endpoint = min(candidates, key=lambda e: (self.state[e][0], random.random()))
+            self.state[endpoint][0] += 1
+            return endpoint
+
+    def release(self, endpoint, failed):
+        with self.lock:
+            state = self.state.get(endpoint)
+            if state is None:
+                # Removed while the request was outstanding
+                return
+            state[0] = max(0, state[0] - 1)
+            if not failed:
+                state[1] = 0
+                return
+            state[1] += 1
+            if state[1] < self.consecutive_errors:
+                return
+            state[1] = 0
+            state[2] = time.monotonic() + self.ejection_time
+        endpoints_ejected_counter.labels(destination_app=self.destination_app).inc()
+        logger.warning(f"Ejected {endpoint} from {self.destination_app} for {self.ejection_time}s")
+
+    def get(self, url, **kwargs):
+        endpoint = self.pick() if url.startswith(self.base) else None
+        if endpoint is None:
+            return requests.get(url, **kwargs)
+        try:
+            res = requests.get(endpoint + url[len(self.base):], **kwargs)
+        except Exception:
+            self.release(endpoint, True)
+            raise
+        # Same mapping as the getProduct* functions: 401/403/404 are answers, 5xx are failures of the endpoint
+        self.release(endpoint, res.status_code >= 500)
+        return res
+
+
+balancers = {name: Balancer(name, service['name'], lbPolicy, outlierConsecutiveErrors, outlierEjectionTime)
+             for name, service in (('details', details), ('reviews', reviews), ('ratings', ratings))}
+for name, balancer in balancers.items():
+    balancer.update(os.environ.get(name.upper() + "_ENDPOINTS", "").split(","))
+
+
+def load_endpoints_file(path, mtime=None):
+    """ Loads the endpoints file if it changed since mtime, and returns its modification time. The file must be a
+    JSON object of lists of URLs by backend name, anything else is logged and skipped """
+    current = os.stat(path).st_mtime
+    if current != mtime:
+        with open(path) as f:
+            endpoints = json.load(f)
+        if not isinstance(endpoints, dict):
+            logger.error(f"Ignoring {path}: expected a JSON object of endpoint lists by backend")
+            return current
+        for name, balancer in balancers.items():
+            if name not in endpoints:
+                continue
+            urls = endpoints[name]
+            if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+                logger.error(f"Ignoring the {name} endpoints of {path}: expected a list of URLs")
+                continue
+            balancer.update(urls)
+    return current
+
+
+def watch_endpoints_file(path, interval, mtime):
+    while True:
+        time.sleep(interval)
+        try:
+            mtime = load_endpoints_file(path, mtime)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to load endpoints from {path}: {repr(e)}")
+
+
+def backend_get(url, destination_app, **kwargs):
+    balancer = balancers.get(destination_app)
+    if balancer is not None:
+        return balancer.get(url, **kwargs)
     return requests.get(url, **kwargs)
 
 
+class Timers(object):
+    """ Calls functions after a delay, all on one thread """
+
+    def __init__(self, name):
+        self.name = name
+        self.cond = threading.Condition()
+        self.heap = []
+        self.seq = itertools.count()
+        self.thread = None
+
+    def call_later(self, delay, f):
+        with self.cond:
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.seq), f))
+            self.cond.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.cond.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                _, _, f = heapq.heappop(self.heap)
+            try:
+                f()
+            except Exception as e:
+                logger.error(f"Timer of {self.name} failed: {repr(e)}")
+
+
+class Hedger(object):
+    """ Hedges the GET requests to one backend.
+
+    The request is sent from the executor. If it has not returned within the percentile latency of the recent requests,
+    a second request is sent, and the first successful response is returned. Every request adds budget to a bucket of
+    at most max_tokens hedges, and every hedge takes one from it, so hedging cannot multiply the load on a slow
+    backend. The caller waits at most timeout seconds.
+    """
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=64, thread_name_prefix='hedge')
+    timers = Timers('hedge-timer')
+
+    def __init__(self, destination_app, percentile, min_delay, budget, timeout=3.0, max_tokens=10, window=1000,
+                 min_samples=20):
+        self.destination_app = destination_app
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.budget = budget
+        self.timeout = timeout
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.min_samples = min_samples
+        self.latencies = collections.deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def delay(self):
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return self.min_delay
+            ordered = sorted(self.latencies)
+        return max(self.min_delay, ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100.0))])
+
+    def timed_get(self, url, **kwargs):
+        start = time.monotonic()
+        res = backend_get(url, self.destination_app, **kwargs)
+        with self.lock:
+            self.latencies.append(time.monotonic() - start)
+        return res
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.budget)
+
+        # Both requests run in the executor and put their future in done when they return
+        done = queue.Queue()
+        # [no more hedges, requests in flight], guarded by the lock of the hedger
+        attempt = [False, 1]
+
+        def send_hedge():
+            with self.lock:
+                if attempt[0] or self.tokens < 1:
+                    return
+                self.tokens -= 1
+                attempt[1] += 1
+            hedges_sent_counter.labels(destination_app=self.destination_app).inc()
+            self.executor.submit(self.timed_get, url, **kwargs).add_done_callback(done.put)
+
+        primary = self.executor.submit(self.timed_get, url, **kwargs)
+        primary.add_done_callback(done.put)
+        self.timers.call_later(self.delay(), send_hedge)
+
+        deadline = time.monotonic() + self.timeout
+        res = error = None
+        while True:
+            with self.lock:
+                if attempt[1] == 0:
+                    break
+            try:
+                future = done.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            with self.lock:
+                attempt[1] -= 1
+                if future is primary:
+                    attempt[0] = True
+            try:
+                res = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if res.status_code < 500:
+                with self.lock:
+                    attempt[0] = True
+                if future is not primary:
+                    hedges_won_counter.labels(destination_app=self.destination_app).inc()
+                return res
+        with self.lock:
+            attempt[0] = True
+        if res is not None:
+            return res
+        if error is not None:
+            raise error
+        raise requests.exceptions.Timeout('no response from %s within %ss' % (self.destination_app, self.timeout))
+
+
+hedgers = {name: Hedger(name, hedgePercentile, hedgeMinDelay, hedgeBudget, hedgeTimeout) for name in hedgeBackends}
+
+
+@timed_phase('json_decode')
+def decode_json(res):
+    return res.json()
+
+
+@timed_phase('backend_calls')
+def send_request(url, destination_app=None, **kwargs):
+    # We intentionally do not pool so that we can easily test load distribution across many versions of our backends
+    hedger = hedgers.get(destination_app)
+    if hedger is not None:
+        return hedger.get(url, **kwargs)
+    return backend_get(url, destination_app, **kwargs)
+
+
 def get_trace_id():
     # Envoyの作成したtraceparent値を取得する
     traceparent = request.headers.get("traceparent")
@@ -552,6 +1362,45 @@ def get_trace_id():
             return parts[1]
     return "unknown"
 
+
+ready = threading.Event()
+
+
+def watch_endpoints():
+    try:
+        mtime = load_endpoints_file(backendEndpointsFile)
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to load endpoints from {backendEndpointsFile}: {repr(e)}")
+        mtime = None
+    threading.Thread(target=watch_endpoints_file, args=(backendEndpointsFile, backendEndpointsRefresh, mtime),
+                     name='endpoints', daemon=True).start()
+
+
+def compile_templates():
+    for template in ('productpage.html', 'product_details.html', 'index.html'):
+        app.jinja_env.get_template(template)
+
+
+def warmup():
+    """ Warms up the request path in the background, then flips /ready. A failed step is logged and skipped, since
+    the request path works without it, only slower """
+    steps = [('jwks', jwks_cache.start), ('tracing', init_tracing), ('templates', compile_templates)]
+    if backendEndpointsFile:
+        steps.insert(1, ('endpoints', watch_endpoints))
+    for name, step in steps:
+        try:
+            step()
+        except Exception as e:
+            logger.error(f"Warmup step {name} failed: {repr(e)}")
+    mark_startup("warmup")
+    ready.set()
+    logger.bind(startup_profile=startup_profile).info("Product page is ready")
+
+
+mark_startup("app")
+threading.Thread(target=warmup, name='warmup', daemon=True).start()
+
+
 class Writer(object):
     def __init__(self, filename):
         self.file = open(filename, 'w')
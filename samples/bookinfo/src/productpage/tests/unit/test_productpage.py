@@ -18,11 +18,24 @@
 # pip install -r test-requirements.txt
 # python -m unittest discover tests/unit
 
+import gzip
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
+import requests
 import requests_mock
+from authlib.jose import JsonWebKey, jwt
 
-import productpage
+# The background warmup started on import fetches the JWKS, keep it away from the real Keycloak
+with mock.patch.dict(os.environ, {'KEYCLOAK_URL': 'http://127.0.0.1:9'}):
+    import productpage
 
 
 class ApplianceTest(unittest.TestCase):
@@ -86,3 +99,289 @@ class ApplianceTest(unittest.TestCase):
         actual = self.app.get(uri, headers=headers)
         print(actual.data)
         self.assertEqual(200, actual.status_code)
+
+    @requests_mock.Mocker()
+    def test_jwks_cache_refresh(self, m):
+        """ Check that the JWKS is fetched once and refreshed on a kid miss at most once per interval """
+        uri = "http://keycloak:8080/realms/bookinfo/protocol/openid-connect/certs"
+        m.get(uri, json={'keys': []})
+        cache = productpage.JWKSCache(uri, ttl=300, min_refresh_interval=60, timeout=1)
+
+        self.assertEqual({'keys': []}, cache.fetch_jwk_set())
+        cache.fetch_jwk_set()
+        cache.fetch_jwk_set(force=True)
+        self.assertEqual(1, m.call_count)
+
+        cache.fetched_at -= 60
+        cache.fetch_jwk_set(force=True)
+        self.assertEqual(2, m.call_count)
+
+    @requests_mock.Mocker()
+    def test_jwks_cache_retry(self, m):
+        """ Check that a failed JWKS fetch at startup is retried well before the ttl, whatever it raised """
+        uri = "http://keycloak:8080/realms/bookinfo/protocol/openid-connect/certs"
+        m.get(uri, [{'exc': RuntimeError('boom')}, {'status_code': 503}, {'json': {'keys': []}}])
+        cache = productpage.JWKSCache(uri, ttl=300, min_refresh_interval=60, timeout=1, retry_interval=0.01)
+        cache.start()
+
+        deadline = time.monotonic() + 5
+        while cache.jwks is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual({'keys': []}, cache.jwks)
+        self.assertEqual(3, m.call_count)
+
+    @requests_mock.Mocker()
+    def test_id_token_verified_locally(self, m):
+        """ Check that ID tokens are verified against the cached JWKS without calling Keycloak """
+        key = JsonWebKey.generate_key('RSA', 2048, is_private=True, options={'kid': 'test'})
+        now = int(time.time())
+        claims = {'iss': 'keycloak', 'sub': 'izzy', 'aud': 'productpage', 'iat': now, 'exp': now + 60,
+                  'given_name': 'izzy'}
+        id_token = jwt.encode({'alg': 'RS256', 'kid': 'test'}, claims, key).decode('utf-8')
+
+        cached = productpage.jwks_cache.jwks
+        productpage.jwks_cache.jwks = {'keys': [key.as_dict()]}
+        try:
+            # No request is registered with the mock, so any call to Keycloak fails the test.
+            with productpage.app.test_request_context('/callback'):
+                userinfo = productpage.get_oauth().keycloak.parse_id_token(
+                    {'id_token': id_token, 'access_token': 'token'}, None)
+        finally:
+            productpage.jwks_cache.jwks = cached
+
+        self.assertEqual('izzy', userinfo['given_name'])
+        self.assertEqual(0, m.call_count)
+
+    def test_ready(self):
+        """ Check that /ready flips once the request path is warm """
+        self.assertTrue(productpage.ready.wait(10))
+        actual = self.app.get('/ready')
+        self.assertEqual(200, actual.status_code)
+
+    def test_warmup_failure(self):
+        """ Check that a failed warmup step is skipped and /ready still flips """
+        self.assertTrue(productpage.ready.wait(10))
+        productpage.ready.clear()
+        with mock.patch.object(productpage, 'init_tracing', side_effect=TypeError('broken')), \
+                mock.patch.object(productpage.jwks_cache, 'start'):
+            productpage.warmup()
+
+        self.assertTrue(productpage.ready.is_set())
+
+    def test_products_etag(self):
+        """ Check that the products list has a strong ETag and answers 304 when it matches """
+        actual = self.app.get('/api/v1/products')
+        self.assertEqual(200, actual.status_code)
+        etag, weak = actual.get_etag()
+        self.assertFalse(weak)
+
+        actual = self.app.get('/api/v1/products', headers={'If-None-Match': '"%s"' % etag})
+        self.assertEqual(304, actual.status_code)
+        self.assertEqual(b'', actual.data)
+
+    def test_compression(self):
+        """ Check that responses over the size threshold are gzip compressed when the client accepts it """
+        compressor = productpage.compressor
+        productpage.compressor = productpage.Compressor(min_size=100, level=6)
+        productpage.compressor.brotli = None
+        try:
+            plain = self.app.get('/api/v1/products')
+            actual = self.app.get('/api/v1/products', headers={'Accept-Encoding': 'gzip'})
+        finally:
+            productpage.compressor = compressor
+
+        self.assertIsNone(plain.headers.get('Content-Encoding'))
+        self.assertEqual('gzip', actual.headers['Content-Encoding'])
+        self.assertEqual(plain.data, gzip.decompress(actual.data))
+        self.assertNotEqual(plain.get_etag(), actual.get_etag())
+
+    def test_admission_shedding(self):
+        """ Check that requests over the limit are shed with 503, except /health """
+        admission = productpage.admission
+        productpage.admission = productpage.AdmissionController(max_in_flight=1, queue_depth=0, queue_timeout=0)
+        try:
+            self.assertTrue(productpage.admission.acquire(productpage.PRIORITY_PAGE))
+            shed = self.app.get('/api/v1/products')
+            health = self.app.get('/health')
+            productpage.admission.release(0)
+            admitted = self.app.get('/api/v1/products')
+        finally:
+            productpage.admission = admission
+
+        self.assertEqual(503, shed.status_code)
+        self.assertEqual(200, health.status_code)
+        self.assertEqual(200, admitted.status_code)
+
+    def test_admission_adaptive_limit(self):
+        """ Check that the limit decreases on slow requests and recovers on fast ones """
+        admission = productpage.AdmissionController(max_in_flight=10, queue_depth=0, queue_timeout=0,
+                                                    target_latency=0.1)
+        for _ in range(10):
+            admission.acquire(productpage.PRIORITY_API)
+            admission.release(1.0)
+        self.assertLess(admission.limit, 5)
+
+        for _ in range(200):
+            admission.acquire(productpage.PRIORITY_API)
+            admission.release(0.01)
+        self.assertEqual(10, admission.limit)
+
+    @requests_mock.Mocker()
+    def test_hedged_reviews(self, m):
+        """ Check that a slow reviews request is hedged and the first response is used without waiting for the other """
+        calls = []
+
+        def reviews(request, context):
+            calls.append(request)
+            if len(calls) == 1:
+                self.assertEqual(2.0, request.timeout)
+                time.sleep(1.0)
+                return '{"slow": true}'
+            return '{"slow": false}'
+
+        m.get("http://reviews:9080/reviews/0", text=reviews)
+        productpage.hedgers['reviews'] = productpage.Hedger('reviews', percentile=95, min_delay=0.05, budget=0.1, timeout=2.0)
+        try:
+            start = time.monotonic()
+            actual = self.app.get('/api/v1/products/0/reviews')
+            elapsed = time.monotonic() - start
+        finally:
+            del productpage.hedgers['reviews']
+
+        self.assertEqual(200, actual.status_code)
+        self.assertEqual({'slow': False}, actual.json)
+        self.assertEqual(2, len(calls))
+        self.assertLess(elapsed, 0.5)
+
+    def test_least_request_balancing(self):
+        """ Check that the endpoint with the fewest outstanding requests is picked """
+        balancer = productpage.Balancer('details', 'http://details:9080', 'least_request', 5, 30)
+        self.assertIsNone(balancer.pick())
+
+        balancer.update(['http://10.0.0.1:9080', 'http://10.0.0.2:9080/'])
+        first = balancer.pick()
+        second = balancer.pick()
+        self.assertEqual({'http://10.0.0.1:9080', 'http://10.0.0.2:9080'}, {first, second})
+        balancer.release(second, False)
+        self.assertEqual(second, balancer.pick())
+
+    def test_endpoints_file(self):
+        """ Check that the endpoints file sets lists of endpoints and that values of other types are skipped """
+        balancers = productpage.balancers
+        productpage.balancers = {name: productpage.Balancer(name, 'http://%s:9080' % name, 'least_request', 5, 30)
+                                 for name in ('details', 'reviews')}
+        try:
+            with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+                json.dump({'details': ['http://10.0.0.1:9080'], 'reviews': 'http://10.0.0.2:9080'}, f)
+                f.flush()
+                mtime = productpage.load_endpoints_file(f.name)
+
+                f.seek(0)
+                f.truncate()
+                json.dump(['http://10.0.0.3:9080'], f)
+                f.flush()
+                productpage.load_endpoints_file(f.name, mtime - 1)
+
+            self.assertEqual(['http://10.0.0.1:9080'], productpage.balancers['details'].endpoints)
+            self.assertEqual([], productpage.balancers['reviews'].endpoints)
+        finally:
+            productpage.balancers = balancers
+
+    @requests_mock.Mocker()
+    def test_outlier_ejection(self, m):
+        """ Check that an endpoint returning 5xx is ejected and requests go to the healthy one """
+        m.get("http://10.0.0.1:9080/details/0", status_code=503)
+        m.get("http://10.0.0.2:9080/details/0", text='{"id": 0}')
+        balancer = productpage.Balancer('details', 'http://details:9080', 'p2c', 2, 30)
+        balancer.update(['http://10.0.0.1:9080', 'http://10.0.0.2:9080'])
+        productpage.balancers['details'], default = balancer, productpage.balancers['details']
+        try:
+            statuses = [self.app.get('/api/v1/products/0').status_code for _ in range(20)]
+        finally:
+            productpage.balancers['details'] = default
+
+        self.assertLessEqual(statuses.count(503), 2)
+        self.assertEqual([200] * 10, statuses[-10:])
+        self.assertGreater(balancer.state['http://10.0.0.1:9080'][2], time.monotonic())
+
+    @requests_mock.Mocker()
+    def test_fragment_cache(self, m):
+        """ Check that the details fragment is reused across requests and re-rendered when the details change """
+        m.get("http://details:9080/details/0", text='{"publisher": "Publisher A"}')
+        m.get("http://reviews:9080/reviews/0", text='{"reviews": []}')
+        productpage.fragment_cache, default = productpage.FragmentCache(8), productpage.fragment_cache
+        try:
+            first = self.app.get('/productpage')
+            second = self.app.get('/productpage')
+            self.assertEqual(1, len(productpage.fragment_cache.fragments))
+
+            m.get("http://details:9080/details/0", text='{"publisher": "Publisher B"}')
+            third = self.app.get('/productpage')
+            self.assertEqual(2, len(productpage.fragment_cache.fragments))
+        finally:
+            productpage.fragment_cache = default
+
+        self.assertEqual(first.data, second.data)
+        self.assertIn(b'Publisher A', second.data)
+        self.assertIn(b'Publisher B', third.data)
+        self.assertIn(b'The Comedy of Errors', third.data)
+
+    @requests_mock.Mocker()
+    def test_profile(self, m):
+        """ Check that /admin/profile requires the token and collects stacks and phases of concurrent requests """
+        m.get("http://ratings:9080/ratings/0", text='{}')
+        self.assertEqual(404, self.app.get('/admin/profile?seconds=0').status_code)
+
+        token = productpage.profilerToken
+        productpage.profilerToken = 'secret'
+        results = {}
+
+        def run_profile(fmt):
+            results[fmt] = productpage.app.test_client().get(
+                '/admin/profile?seconds=0.3&format=' + fmt, headers={'x-profiler-token': 'secret'})
+
+        try:
+            self.assertEqual(400, self.app.get('/admin/profile?interval=x', headers={'x-profiler-token': 'secret'})
+                             .status_code)
+            profiler = threading.Thread(target=run_profile, args=('phases',))
+            profiler.start()
+            time.sleep(0.1)
+            self.app.get('/api/v1/products/0/ratings')
+            profiler.join()
+            # Profiled from another thread, so the stack of this one is sampled
+            profiler = threading.Thread(target=run_profile, args=('collapsed',))
+            profiler.start()
+            profiler.join()
+        finally:
+            productpage.profilerToken = token
+
+        phases = results['phases'].json['ratingsRoute']
+        for name in ('total', 'header_propagation', 'backend_calls', 'json_decode'):
+            self.assertEqual(1, phases[name]['count'])
+        self.assertEqual(200, results['collapsed'].status_code)
+        self.assertIn(b'MainThread;', results['collapsed'].data)
+
+    def test_profile_gevent(self):
+        """ Check that the stack of a busy greenlet is sampled under gevent monkey patching """
+        script = """
+from gevent import monkey
+monkey.patch_all()
+import gevent, time
+import productpage
+
+def busy_loop():
+    end = time.monotonic() + 0.5
+    while time.monotonic() < end:
+        sum(range(1000))
+
+sampler = gevent.spawn(productpage.sample_all_stacks, 0.3, 0.01)
+gevent.sleep(0.05)
+gevent.spawn(busy_loop)
+print('STACKS', list(sampler.get()))
+"""
+        env = dict(os.environ, PYTHONPATH=os.getcwd())
+        out = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True, timeout=60).stdout
+        stacks = [line for line in out.splitlines() if line.startswith('STACKS')]
+        self.assertEqual(1, len(stacks))
+        self.assertIn('busy_loop', stacks[0])
+        self.assertNotIn('sample_stacks', stacks[0])
@@ -0,0 +1,238 @@
+# Copyright Istio Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Signing helpers shared by sa-jwt.py and samples/gen-jwt.py.
+
+A signer parses its private key once and can then sign any number of
+payloads, either in process or through `serve`, which reads claim requests
+from stdin and writes one signed token per line to stdout. `TokenPool`
+keeps a set of tokens signed ahead of time for load tests.
+"""
+from __future__ import print_function
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+
+class JWKSigner(object):
+    """Signs tokens with a jwcrypto key. alg must match the key type, e.g.
+    RS256/PS256 for RSA, ES256 for EC P-256 or EdDSA for Ed25519 keys."""
+
+    def __init__(self, key, alg="RS256"):
+        self.key = key
+        self.alg = alg
+        self.header = {"alg": alg, "typ": "JWT", "kid": key.key_id or key.thumbprint()}
+
+    def sign(self, payload):
+        """Returns the serialized token for payload."""
+        from jwcrypto import jwt
+
+        token = jwt.JWT(header=self.header, claims=payload)
+        token.make_signed_token(self.key)
+
+        return token.serialize()
+
+    def jwks(self):
+        """Returns the public key set of the key."""
+        return "{ \"keys\":[ " + self.key.export(private_key=False) + "]}"
+
+
+class PemSigner(JWKSigner):
+    """Signs tokens with a PEM private key, e.g. `openssl genrsa -out key.pem 2048`."""
+
+    def __init__(self, path, alg="RS256"):
+        from jwcrypto import jwk
+
+        with open(path) as f:
+            pem_data = f.read()
+
+        super(PemSigner, self).__init__(jwk.JWK.from_pem(pem_data.encode("utf-8")), alg)
+
+
+class ServiceAccountSigner(object):
+    """Signs tokens with the private key of a Google service account key file."""
+
+    def __init__(self, path):
+        import google.auth.crypt
+
+        self.signer = google.auth.crypt.RSASigner.from_service_account_file(path)
+
+    def sign(self, payload):
+        """Returns the serialized token for payload."""
+        import google.auth.jwt
+
+        return google.auth.jwt.encode(self.signer, payload).decode("utf-8")
+
+
+def write_jwks(path, signer):
+    """Writes the public key set of signer to path, unless the file already
+    holds it."""
+    jwks = signer.jwks()
+    try:
+        with open(path) as f:
+            if f.read() == jwks:
+                return
+    except IOError:
+        pass
+
+    with open(path, "w+") as fout:
+        fout.write(jwks)
+
+
+def build_payload(iss=None, sub=None, aud=None, claims=None, expire=3600, now=None):
+    """Builds the standard claims shared by the tools.
+
+    aud is a comma-separated-list of audiences, and claims is in format
+    name1:value1,name2:value2. sub defaults to iss. samples/gen-jwt.py has a
+    copy of this in its build_payload, so it can sign single tokens on its
+    own. Change both together.
+    """
+    if now is None:
+        now = int(time.time())
+
+    payload = {
+        "exp": now + expire,
+        "iat": now,
+    }
+    if iss:
+        payload["iss"] = iss
+
+    if sub:
+        payload["sub"] = sub
+    else:
+        payload["sub"] = iss
+
+    if aud:
+        if "," in aud:
+            payload["aud"] = aud.split(",")
+        else:
+            payload["aud"] = aud
+
+    if claims:
+        for item in claims.split(","):
+            k, v = item.split(':')
+            payload[k] = v
+
+    return payload
+
+
+def apply_claims(payload, claims):
+    """Overrides payload with the claims of a request. An `expire` claim sets
+    the expiration time in second relative to `iat`."""
+    claims = dict(claims)
+    expire = claims.pop("expire", None)
+    payload.update(claims)
+    if expire is not None:
+        payload["exp"] = payload["iat"] + int(expire)
+
+    return payload
+
+
+def serve(signer, make_payload, infile=sys.stdin, outfile=sys.stdout):
+    """Signs one token per request until infile is closed.
+
+    Each line of infile is a JSON object of claims, applied on top of
+    make_payload(), which is called per request so `iat` and `exp` are
+    current. An empty line requests a token with the default claims. The
+    token, or an empty line if the request is invalid, is written as one line
+    to outfile.
+    """
+    for line in iter(infile.readline, ""):
+        try:
+            claims = json.loads(line) if line.strip() else {}
+            token = signer.sign(apply_claims(make_payload(), claims))
+        except (ValueError, TypeError, AttributeError) as e:
+            print("invalid request: {!r}".format(e), file=sys.stderr)
+            token = ""
+
+        outfile.write(token + "\n")
+        outfile.flush()
+
+
+class TokenPool(object):
+    """A fixed size pool of signed tokens, handed out round-robin.
+
+    make_payload(i) returns the payload of slot i. Tokens are re-signed in
+    batches once they are within refresh_before seconds of their expiration,
+    so `get` never signs on the caller's path.
+    """
+
+    def __init__(self, signer, make_payload, size, refresh_before, batch=100):
+        self.signer = signer
+        self.make_payload = make_payload
+        self.size = size
+        self.refresh_before = refresh_before
+        self.batch = batch
+        self.lock = threading.Lock()
+        self.next = 0
+        # (exp, token) per slot
+        self.tokens = [None] * size
+        self.refresh(force=True)
+
+    def sign(self, i):
+        payload = self.make_payload(i)
+        return payload["exp"], self.signer.sign(payload)
+
+    def expiring(self, now):
+        with self.lock:
+            return [i for i, t in enumerate(self.tokens)
+                    if t is None or t[0] - now <= self.refresh_before]
+
+    def refresh(self, force=False):
+        """Re-signs the expiring tokens, or all of them when forced, and
+        returns how many were re-signed."""
+        slots = list(range(self.size)) if force else self.expiring(int(time.time()))
+        for start in range(0, len(slots), self.batch):
+            signed = [(i, self.sign(i)) for i in slots[start:start + self.batch]]
+            with self.lock:
+                for i, t in signed:
+                    self.tokens[i] = t
+
+        return len(slots)
+
+    def get(self):
+        """Returns the next token, round-robin."""
+        with self.lock:
+            i = self.next
+            self.next = (i + 1) % self.size
+            return self.tokens[i][1]
+
+    def write(self, path):
+        """Writes all tokens to path, one per line. The file is replaced
+        atomically so readers never see a partial pool."""
+        with self.lock:
+            tokens = [t[1] for t in self.tokens]
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, "w") as f:
+            f.write("\n".join(tokens) + "\n")
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+
+    def run(self, interval, on_refresh=None):
+        """Refreshes the pool every interval seconds, forever."""
+        while True:
+            time.sleep(interval)
+            if self.refresh() and on_refresh:
+                on_refresh()
+
+    def start(self, interval, on_refresh=None):
+        """Runs `run` in a daemon thread."""
+        t = threading.Thread(target=self.run, args=(interval, on_refresh))
+        t.daemon = True
+        t.start()
+        return t
@@ -21,43 +21,20 @@ Example:
 """
 from __future__ import print_function
 import argparse
-import time
 
-import google.auth.crypt
-import google.auth.jwt
+import jwtsigner
 
 
-def main(args):
-    """Generates a signed JSON Web Token using a Google API Service Account."""
-    signer = google.auth.crypt.RSASigner.from_service_account_file(
-        args.service_account_file)
-    now = int(time.time())
-    payload = {
-        # expire in one hour.
-        "exp": now + 3600,
-        "iat": now,
-    }
-    if args.iss:
-        payload["iss"] = args.iss
-
-    if args.sub:
-        payload["sub"] = args.sub
-    else:
-        payload["sub"] = args.iss
+def build_payload(args):
+    # expire in one hour.
+    return jwtsigner.build_payload(iss=args.iss, sub=args.sub, aud=args.aud,
+                                   claims=args.claims, expire=3600)
 
-    if args.aud:
-        if "," in args.aud:
-            payload["aud"] = args.aud.split(",")
-        else:
-            payload["aud"] = args.aud
 
-    if args.claims:
-        for item in args.claims.split(","):
-            k, v = item.split(':')
-            payload[k] = v
-
-    signed_jwt = google.auth.jwt.encode(signer, payload)
-    return signed_jwt
+def main(args):
+    """Generates a signed JSON Web Token using a Google API Service Account."""
+    signer = jwtsigner.ServiceAccountSigner(args.service_account_file)
+    return signer.sign(build_payload(args))
 
 
 if __name__ == '__main__':
@@ -77,4 +54,12 @@ if __name__ == '__main__':
                         help="sub claim. If not provided, it is set to the same as iss claim.")
     parser.add_argument("-claims", "--claims",
                         help="Other claims in format name1:value1,name2:value2 etc. Only string values are supported.")
-    print(main(parser.parse_args()))
+    parser.add_argument("-serve", "--serve", action="store_true",
+                        help="Load the key once and sign one token per line read from stdin until it is closed. "
+                             "Each line is a JSON object of claims applied on top of the command line claims.")
+    args = parser.parse_args()
+    if args.serve:
+        signer = jwtsigner.ServiceAccountSigner(args.service_account_file)
+        jwtsigner.serve(signer, lambda: build_payload(args))
+    else:
+        print(main(args))
@@ -18,34 +18,100 @@
 
 Example:
 ./gen-jwt.py  --iss example-issuer --aud foo,bar --claims=email:foo@google.com,dead:beef key.pem -listclaim key1 val2 val3 -listclaim key2 val3 val4
+
+Bulk example, 100000 tokens with sub user-0 ... user-99999 signed by 8 processes:
+./gen-jwt.py key.pem --count 100000 --sub 'user-{i}' --jobs 8 > tokens.txt
+
+Serve example, one token per JSON claims line read from stdin:
+echo '{"sub": "alice", "expire": 60}' | ./gen-jwt.py key.pem --serve
+
+Benchmark example, signing throughput and latency of every algorithm and key size as JSON:
+./gen-jwt.py --benchmark 1000 -listclaim groups g1 g2 -nestedclaim key1 val1
+
+Pool example, 1000 tokens kept valid in tokens.txt and served round-robin at http://localhost:8000/:
+./gen-jwt.py key.pem --sub 'user-{i}' --expire 600 --pool-size 1000 --pool-file tokens.txt --pool-port 8000
 """
 from __future__ import print_function
 import argparse
 import copy
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import sys
 import time
+import timeit
 
 from jwcrypto import jwt, jwk
 
+# the shared signing helpers of ../jwtsigner.py, see load_jwtsigner
+jwtsigner = None
+
+# signer used by sign_payload, loaded once per process
+_signer = None
+
+# (alg, key parameters) measured by --benchmark
+BENCHMARK_KEYS = [
+    ("RS256", {"kty": "RSA", "size": 2048}),
+    ("RS256", {"kty": "RSA", "size": 3072}),
+    ("RS256", {"kty": "RSA", "size": 4096}),
+    ("RS384", {"kty": "RSA", "size": 2048}),
+    ("RS384", {"kty": "RSA", "size": 4096}),
+    ("PS256", {"kty": "RSA", "size": 2048}),
+    ("PS256", {"kty": "RSA", "size": 4096}),
+    ("ES256", {"kty": "EC", "crv": "P-256"}),
+    ("EdDSA", {"kty": "OKP", "crv": "Ed25519"}),
+]
+
+
+def load_jwtsigner():
+    """Imports jwtsigner.py from the parent directory. The bulk, serve, pool
+    and benchmark modes need it. Single tokens are signed without it, so the
+    script also works when downloaded on its own."""
+    global jwtsigner
+    if jwtsigner is None:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+        try:
+            import jwtsigner as module
+        except ImportError:
+            sys.exit("This mode needs jwtsigner.py from security/tools/jwt in the parent directory of gen-jwt.py")
+        jwtsigner = module
+
+    return jwtsigner
+
 
 def main(args):
     """Generates a signed JSON Web Token from local private key."""
     with open(args.key) as f:
-        pem_data = f.read()
-    f.closed
-
-    pem_data_encode = pem_data.encode("utf-8")
-    key = jwk.JWK.from_pem(pem_data_encode)
+        key = jwk.JWK.from_pem(f.read().encode("utf-8"))
 
+    # the same as jwtsigner.write_jwks, which single tokens are signed without
     if args.jwks:
-        with open(args.jwks, "w+") as fout:
-            fout.write("{ \"keys\":[ ")
-            fout.write(key.export(private_key=False))
-            fout.write("]}")
-        fout.close
+        jwks = "{ \"keys\":[ " + key.export(private_key=False) + "]}"
+        try:
+            with open(args.jwks) as f:
+                unchanged = f.read() == jwks
+        except IOError:
+            unchanged = False
+        if not unchanged:
+            with open(args.jwks, "w+") as fout:
+                fout.write(jwks)
+
+    # the same as jwtsigner.JWKSigner.sign, keep them in sync
+    token = jwt.JWT(header={"alg": args.alg, "typ": "JWT", "kid": key.key_id or key.thumbprint()},
+                    claims=build_payload(args, int(time.time())))
+    token.make_signed_token(key)
+
+    return token.serialize()
+
 
-    now = int(time.time())
+def build_payload(args, now):
+    """Builds the claims from the command line arguments. The standard claims
+    are a copy of jwtsigner.build_payload, so that single tokens do not need
+    jwtsigner.py, and the two must be kept in sync."""
     payload = {
-        # expire in one hour.
         "exp": now + args.expire,
         "iat": now,
     }
@@ -86,12 +152,177 @@ def main(args):
         nested["nested-2"] = copy.copy(nested)
         payload[args.nestedkey] = nested
 
-    token = jwt.JWT(header={"alg": "RS256", "typ": "JWT", "kid": key.key_id},
-                    claims=payload)
+    return payload
 
-    token.make_signed_token(key)
 
-    return token.serialize()
+def read_claims_file(path):
+    """Yields the claims of each row of a CSV file with a header row, or of
+    each line of a JSONL file."""
+    with open(path) as f:
+        if path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                yield {k: v for k, v in row.items() if v}
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def render(value, i):
+    """Replaces `{i}` in the string values of a claim with the token index."""
+    if isinstance(value, str):
+        return value.replace("{i}", str(i))
+    if isinstance(value, list):
+        return [render(v, i) for v in value]
+    if isinstance(value, dict):
+        return {k: render(v, i) for k, v in value.items()}
+    return value
+
+
+def bulk_payloads(args):
+    """Yields the payload of every token to generate in bulk mode.
+
+    The command line claims are the template for every token. Rows of the
+    claims file override them, and an `expire` column or key overrides
+    `--expire` for that token.
+    """
+    if args.claims_file:
+        rows = read_claims_file(args.claims_file)
+        if args.count:
+            rows = itertools.islice(rows, args.count)
+    else:
+        rows = ({} for _ in range(args.count))
+
+    template = build_payload(args, int(time.time()))
+    for i, row in enumerate(rows):
+        yield jwtsigner.apply_claims(render(template, i), row)
+
+
+def init_worker(path, alg):
+    global _signer
+    _signer = load_jwtsigner().PemSigner(path, alg)
+
+
+def sign_payload(payload):
+    return _signer.sign(payload)
+
+
+def bulk(args):
+    """Generates tokens in bulk, one per line, loading the key once."""
+    init_worker(args.key, args.alg)
+
+    if args.jwks:
+        jwtsigner.write_jwks(args.jwks, _signer)
+
+    payloads = bulk_payloads(args)
+    if args.jobs > 1:
+        with multiprocessing.Pool(args.jobs, init_worker, (args.key, args.alg)) as pool:
+            write_tokens(pool.imap(sign_payload, payloads, chunksize=256))
+    else:
+        write_tokens(map(sign_payload, payloads))
+
+
+def write_tokens(tokens):
+    for token in tokens:
+        sys.stdout.write(token + "\n")
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def benchmark(args):
+    """Measures signing throughput and latency of each algorithm and key size
+    in BENCHMARK_KEYS, for each padding size, with a freshly generated key.
+
+    The payload is built from the command line claims, including list and
+    nested claims, plus a `pad` claim of the given size.
+    """
+    load_jwtsigner()
+
+    algs = args.benchmark_algs.split(",") if args.benchmark_algs else None
+    pads = [int(p) for p in args.benchmark_pad.split(",")]
+
+    results = []
+    for alg, params in BENCHMARK_KEYS:
+        if algs and alg not in algs:
+            continue
+
+        signer = jwtsigner.JWKSigner(jwk.JWK.generate(**params), alg)
+        for pad in pads:
+            payload = build_payload(args, int(time.time()))
+            if pad:
+                payload["pad"] = "x" * pad
+
+            # warm up
+            signer.sign(payload)
+
+            latencies = []
+            start = timeit.default_timer()
+            for _ in range(args.benchmark):
+                t = timeit.default_timer()
+                signer.sign(payload)
+                latencies.append(timeit.default_timer() - t)
+            elapsed = timeit.default_timer() - start
+
+            latencies.sort()
+            results.append({
+                "alg": alg,
+                "key": "{}-{}".format(params["kty"], params.get("size", params.get("crv"))),
+                "payload_bytes": len(json.dumps(payload)),
+                "tokens": args.benchmark,
+                "tokens_per_sec": round(args.benchmark / elapsed, 1),
+                "latency_ms": {
+                    "mean": round(1000 * elapsed / args.benchmark, 3),
+                    "p50": round(1000 * percentile(latencies, 50), 3),
+                    "p90": round(1000 * percentile(latencies, 90), 3),
+                    "p99": round(1000 * percentile(latencies, 99), 3),
+                    "max": round(1000 * latencies[-1], 3),
+                },
+            })
+
+    print(json.dumps(results, indent=2))
+
+
+def pool(args):
+    """Keeps a pool of tokens valid, re-signing them in the background, and
+    serves them round-robin over HTTP and/or in a file."""
+    signer = load_jwtsigner().PemSigner(args.key, args.alg)
+
+    if args.jwks:
+        jwtsigner.write_jwks(args.jwks, signer)
+
+    refresh_before = args.pool_refresh if args.pool_refresh is not None else args.expire // 4
+    token_pool = jwtsigner.TokenPool(signer, lambda i: render(build_payload(args, int(time.time())), i),
+                                     args.pool_size, refresh_before)
+
+    on_refresh = None
+    if args.pool_file:
+        token_pool.write(args.pool_file)
+
+        def on_refresh():
+            token_pool.write(args.pool_file)
+
+    # check for expiring tokens a few times per refresh window
+    interval = max(1, refresh_before // 4)
+    if not args.pool_port:
+        token_pool.run(interval, on_refresh)
+        return
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            token = token_pool.get().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(token)))
+            self.end_headers()
+            self.wfile.write(token)
+
+        def log_message(self, format, *args):
+            pass
+
+    token_pool.start(interval, on_refresh)
+    ThreadingHTTPServer(("", args.pool_port), Handler).serve_forever()
 
 
 if __name__ == '__main__':
@@ -101,6 +332,7 @@ if __name__ == '__main__':
     # positional arguments
     parser.add_argument(
         'key',
+        nargs='?',
         help='The path to the key pem file. The key can be generated with openssl command: `openssl genrsa -out key.pem 2048`')
     # optional arguments
     parser.add_argument("-iss", "--iss",
@@ -112,6 +344,10 @@ if __name__ == '__main__':
                         help="sub claim. If not provided, it is set to the same as iss claim.")
     parser.add_argument("-claims", "--claims",
                         help="Other claims in format name1:value1,name2:value2 etc. Only string values are supported.")
+    parser.add_argument("-alg", "--alg",
+                        default="RS256",
+                        help="Signing algorithm, which must match the key type, e.g. RS256, PS256, ES256 or EdDSA. "
+                             "Default is `RS256`")
     parser.add_argument("-jwks", "--jwks",
                         help="Path to the output file for JWKS.")
     parser.add_argument("-expire", "--expire", type=int, default=3600,
@@ -133,4 +369,55 @@ if __name__ == '__main__':
         help="Nested claim in format key value1 [value2 ...], only string values are supported, will be added under the nested key in the JWT payload. "
              "Multiple nested claims can be specified, e.g., -nestedclaim key1 val2 val3 -nestedclaim key2 val3 val4."
     )
-    print(main(parser.parse_args()))
+    # bulk mode
+    parser.add_argument("-count", "--count", type=int, default=0,
+                        help="Number of tokens to generate in bulk mode, one per line. `{i}` in claim values is "
+                             "replaced with the token index. Limits the rows read from `claimsfile` if both are given.")
+    parser.add_argument("-claimsfile", "--claims-file", dest="claims_file",
+                        help="CSV (with a header row) or JSONL file with the claims of one token per row, generated "
+                             "in bulk mode on top of the command line claims. An `expire` column sets the expiration "
+                             "time in second for that token.")
+    parser.add_argument("-jobs", "--jobs", type=int, default=1,
+                        help="Number of processes signing tokens in bulk mode. Default is 1.")
+    parser.add_argument("-serve", "--serve", action="store_true",
+                        help="Load the key once and sign one token per line read from stdin until it is closed. "
+                             "Each line is a JSON object of claims applied on top of the command line claims.")
+    # token pool
+    parser.add_argument("-poolsize", "--pool-size", dest="pool_size", type=int, default=0,
+                        help="Keep this many tokens valid, re-signing them before they expire. `{i}` in claim values "
+                             "is replaced with the pool slot. Requires `poolfile` and/or `poolport`.")
+    parser.add_argument("-poolfile", "--pool-file", dest="pool_file",
+                        help="File the token pool is written to, one token per line, after every refresh.")
+    parser.add_argument("-poolport", "--pool-port", dest="pool_port", type=int,
+                        help="Port on which every GET request returns the next token of the pool, round-robin.")
+    parser.add_argument("-poolrefresh", "--pool-refresh", dest="pool_refresh", type=int,
+                        help="Re-sign pool tokens this many seconds before they expire. Default is `expire` / 4.")
+    # benchmark
+    parser.add_argument("-benchmark", "--benchmark", type=int, default=0,
+                        help="Sign this many tokens with a generated key of every algorithm and key size, and print the "
+                             "throughput and latency as JSON. No key file is needed.")
+    parser.add_argument("-benchmarkalgs", "--benchmark-algs", dest="benchmark_algs",
+                        help="Comma-separated-list of algorithms to benchmark. Default is all of RS256, RS384, PS256, "
+                             "ES256 and EdDSA.")
+    parser.add_argument("-benchmarkpad", "--benchmark-pad", dest="benchmark_pad", default="0,1024,8192",
+                        help="Comma-separated-list of sizes in bytes of a padding claim added to the benchmark payload. "
+                             "Default is `0,1024,8192`.")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args)
+        sys.exit(0)
+    if not args.key:
+        parser.error("the following arguments are required: key")
+    if args.pool_size:
+        if not args.pool_file and not args.pool_port:
+            parser.error("--pool-size requires --pool-file or --pool-port")
+        pool(args)
+    elif args.serve:
+        signer = load_jwtsigner().PemSigner(args.key, args.alg)
+        if args.jwks:
+            jwtsigner.write_jwks(args.jwks, signer)
+        jwtsigner.serve(signer, lambda: build_payload(args, int(time.time())))
+    elif args.count or args.claims_file:
+        bulk(args)
+    else:
+        print(main(args))